@@ -1,18 +1,79 @@
 import boto3
-from flask import Flask, request, jsonify, Response, send_from_directory
-from time import time
+from flask import Flask, request, jsonify, Response, send_file, g
+from werkzeug.wsgi import wrap_file
+from datetime import datetime
+from time import time, perf_counter
 import os
 import re
 import json
 import sys
-import subprocess
+import gzip
+import base64
+import zlib
+import signal
+import atexit
+import hashlib
 import logging
+import threading
 import requests
 
+from relay import RelayManager
+from probe import ProbeCache
+from transcode import TranscodeManager, TranscodeBusy
+from logos import LogoStore
+from presign import PresignedUrls
+from epg import ProgrammeIndex, EMPTY_XMLTV
+from hls import HlsProxy, is_hls
+from vodcache import VodCache, cache_key
+from sessions import (
+    CredentialRegistry, StreamSessions, StreamLimitReached
+)
+import datafile
+import metrics
+from catalog_store import (
+    CATALOG_KEYS, MemoryCatalog, sqlite_catalog
+)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 CONFIG = {}
 s3 = None
-s3_presigneds = {}
+presigned_urls = None
+credentials = CredentialRegistry([])
+streams = StreamSessions()
+relays = RelayManager()
+hls = HlsProxy()
+vod_cache = None
+probe_cache = ProbeCache(cache_file=None)
+transcodes = TranscodeManager()
+logo_store = LogoStore()
+
+# player_api list actions served from pre-serialized blobs, see
+# build_response_cache()
+CACHED_ACTIONS = {
+    "get_live_categories": "live_categories",
+    "get_live_streams": "live_streams",
+    "get_vod_categories": "movie_categories",
+    "get_vod_streams": "movie_streams",
+    "get_series_categories": "series_categories",
+    "get_series": "series_streams",
+}
+# list actions accepting a category_id filter
+CATEGORY_ACTIONS = ("get_live_streams", "get_vod_streams", "get_series")
+# player_api actions with their own latency metrics, others are "other"
+API_ACTIONS = set(CACHED_ACTIONS) | {
+    "get_vod_info", "get_short_epg", "get_simple_data_table"
+}
+EMPTY_LIST = "empty_list"
+# Current catalog snapshot, see build_catalog(). It's never modified, a
+# reload builds a new one and swaps it, so requests take a reference once
+# and keep using it.
+CATALOG = {}
+reload_requested = threading.Event()
 app = Flask(__name__)
 
 logging.basicConfig(
@@ -26,11 +87,40 @@ logging.basicConfig(
 log = logging.getLogger(__name__)
 
 
+@app.before_request
+def start_timer():
+    g.request_started = perf_counter()
+
+
+@app.after_request
+def observe_latency(response):
+    # streamed responses are timed up to their headers
+    started = g.get("request_started")
+    if started is None or request.url_rule is None or \
+            request.environ.get("xtreamer.timed"):
+        return response
+    elapsed = perf_counter() - started
+    metrics.REQUEST_SECONDS.observe(elapsed, request.url_rule.rule)
+    if request.endpoint == "player_api":
+        action = request.args.get("action")
+        metrics.PLAYER_API_SECONDS.observe(
+            elapsed,
+            "user_info" if action is None else
+            action if action in API_ACTIONS else "other"
+        )
+    return response
+
+
 def check_login(user, pwd):
-    for cred in CONFIG.get("credentials", []):
-        if user == cred["username"] and pwd == cred["password"]:
-            return True
-    return False
+    return credentials.check(user, pwd)
+
+
+def load_credentials():
+    global credentials, streams
+    credentials = CredentialRegistry(CONFIG.get("credentials", []))
+    streams = StreamSessions(
+        credentials=credentials, **CONFIG.get("streams", {})
+    )
 
 
 @app.route("/player_api.php")
@@ -43,6 +133,8 @@ def player_api():
     if not check_login(username, password):
         return jsonify({"user_info": {"auth": 0}})
 
+    catalog = CATALOG
+
     if action is None:
         host = CONFIG['base_url'].split('http://')[1].split(':')[0]
         port = CONFIG['base_url'].split(":")[-1]
@@ -52,7 +144,9 @@ def player_api():
                 "password": password,
                 "is_trial": 0,
                 "auth": 1,
-                "status": "Active"
+                "status": "Active",
+                "active_cons": str(streams.active(username)),
+                "max_connections": str(streams.user_limit(username) or 0),
             },
             "server_info": {
                 "url": host,
@@ -68,34 +162,32 @@ def player_api():
             # "movie_categories": CONFIG['movie_categories'],
         })
 
-    if action == "get_live_categories":
-        return jsonify(CONFIG['live_categories'])
-
-    if action == "get_live_streams":
-        return jsonify(CONFIG['live_streams'])
-
-    if action == "get_vod_categories":
-        return jsonify(CONFIG['movie_categories'])
-
-    if action == "get_vod_streams":
-        return jsonify(CONFIG['movie_streams'])
-
-    if action == "get_series_categories":
-        return jsonify(CONFIG['series_categories'])
-
-    if action == "get_series":
-        return jsonify(CONFIG['series_streams'])
+    if action in CACHED_ACTIONS:
+        category_id = request.args.get("category_id")
+        if action not in CATEGORY_ACTIONS or not category_id:
+            category_id = None
+
+        if action in catalog["responses"]:
+            if category_id is None:
+                return cached_response(catalog["responses"][action])
+            return cached_response(
+                catalog["responses"].get((action, category_id)) or
+                catalog["responses"][EMPTY_LIST]
+            )
+
+        store = catalog["store"]
+        key = CACHED_ACTIONS[action]
+        # rows of the SQLite catalog are streamed as stored
+        if CONFIG.get("stream_json") or not store.in_memory:
+            return streamed_json_response(store.iter_json(key, category_id))
+        return jsonify(store.records(key, category_id))
 
     if action == "get_vod_info":
-        vod = next(
-            (m for m in CONFIG['movie_streams'] if m["stream_id"] == vod_id),
-            None
-        )
+        vod = catalog["store"].movie(vod_id)
         if not vod:
             return jsonify({"error": "vod not found"})
 
-        if vod.get("s3_hashed_name"):
-            set_or_update_presigned_url(vod)
+        direct_source = movie_source(vod)
 
         return jsonify({
             "info": {
@@ -113,103 +205,204 @@ def player_api():
                 "stream_id": vod_id,
                 "name": vod["name"],
                 "container_extension": vod.get("container_extension", "mp4"),
-                "stream_source": [vod["direct_source"]],
+                "stream_source": [direct_source],
                 "custom_sid": "",
-                "direct_source": vod["direct_source"],
-                "stream_link": vod["direct_source"]
+                "direct_source": direct_source,
+                "stream_link": direct_source
             }
         })
 
+    if action in ("get_short_epg", "get_simple_data_table"):
+        live = catalog["store"].live(int(request.args.get("stream_id", 0)))
+        epg_channel_id = (live or {}).get("epg_channel_id")
+        now = int(time())
+        if action == "get_short_epg":
+            programmes = catalog["epg"].upcoming(
+                epg_channel_id, now, int(request.args.get("limit", 4))
+            )
+        else:
+            programmes = catalog["epg"].programmes(epg_channel_id)
+        return jsonify({"epg_listings": [
+            epg_listing(
+                epg_channel_id, programme, now,
+                table=action == "get_simple_data_table"
+            )
+            for programme in programmes
+        ]})
+
     return jsonify({"error": "Unknown action"}), 400
 
 
-def set_or_update_presigned_url(vod):
-    key = vod["s3_hashed_name"]
-    if not key:
-        log.info(
-            f"No s3_hashed_name for movie {vod['name']} with id "
-            f"{vod['stream_id']}, skipping presigned URL generation."
+def epg_listing(epg_channel_id, programme, now, table=False):
+    start, stop, title, description = programme
+    listing = {
+        "id": str(start),
+        "epg_id": epg_channel_id,
+        "title": base64.b64encode(title.encode("utf-8")).decode("ascii"),
+        "lang": "",
+        "start": datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S"),
+        "end": datetime.fromtimestamp(stop).strftime("%Y-%m-%d %H:%M:%S"),
+        "description":
+            base64.b64encode(description.encode("utf-8")).decode("ascii"),
+        "channel_id": epg_channel_id,
+        "start_timestamp": str(start),
+        "stop_timestamp": str(stop),
+    }
+    if table:
+        listing["now_playing"] = int(start <= now < stop)
+        listing["has_archive"] = 0
+    return listing
+
+
+def build_cached_entry(body):
+    digest = hashlib.sha1(body).hexdigest()
+    encodings = {
+        "identity": body,
+        "gzip": gzip.compress(body, compresslevel=6, mtime=0),
+    }
+    if brotli:
+        encodings["br"] = brotli.compress(body, quality=5)
+    return {
+        "encodings": encodings,
+        "etags": {enc: f"{digest}-{enc}" for enc in encodings},
+    }
+
+
+def build_response_cache(store):
+    """
+    Serialize every list action once, with compressed variants and ETags,
+    so player_api just hands out immutable bytes. Stream lists are also
+    partitioned by category, under (action, category_id) keys, for clients
+    asking for a single category.
+    """
+    cache = {}
+    for action, key in CACHED_ACTIONS.items():
+        rows = list(store.serialized(key))
+        cache[action] = build_cached_entry(
+            b"[" + b",".join(body for _, body in rows) + b"]"
         )
-        return
 
-    direct_source = None
-    if key in s3_presigneds:
-        expires = s3_presigneds[key]['expires']
-        if expires - int(time()) > 3600:  # 1h remaining
-            direct_source = s3_presigneds[key]['url']
-            log.info(f"Using cached presigned URL for movie {vod['name']}")
+        if action not in CATEGORY_ACTIONS:
+            continue
+        partitions = {}
+        for category_id, body in rows:
+            partitions.setdefault(category_id, []).append(body)
+        for category_id, bodies in partitions.items():
+            cache[(action, category_id)] = build_cached_entry(
+                b"[" + b",".join(bodies) + b"]"
+            )
+    cache[EMPTY_LIST] = build_cached_entry(b"[]")
+    return cache
+
+
+def cached_response(entry):
+    encoding = "identity"
+    for enc in ("br", "gzip"):
+        if enc in entry["encodings"] and request.accept_encodings[enc]:
+            encoding = enc
+            break
+
+    etag = entry["etags"][encoding]
+    headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304, headers=headers)
+    else:
+        response = Response(
+            entry["encodings"][encoding],
+            content_type="application/json",
+            headers=headers
+        )
+    response.set_etag(etag)
+    return response
 
-    if direct_source:
-        vod["direct_source"] = direct_source
-        return
 
-    direct_source = s3.generate_presigned_url(
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def streamed_json_response(chunks):
+    headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if request.accept_encodings["gzip"]:
+        headers["Content-Encoding"] = "gzip"
+        chunks = iter_gzip(chunks)
+    return Response(
+        chunks, content_type="application/json", headers=headers
+    )
+
+
+def presign_s3_key(key, expires_in):
+    return s3.generate_presigned_url(
         ClientMethod="get_object",
         Params={
             "Bucket": CONFIG.get('s3_uploads', {}).get('aws', {}).get('s3_bucket'),  # noqa
             "Key": key
         },
-        ExpiresIn=3600*6  # in seconds
+        ExpiresIn=expires_in  # in seconds
     )
-    s3_presigneds[key] = {
-        "url": direct_source,
-        "expires": int(time()) + 3600*6
-    }
-    log.info(f"Generated new presigned URL for movie {vod['name']}")
-    vod["direct_source"] = direct_source
-    return
-
-
-def detect_audio_codec(url, timeout=5):
-    cmd = [
-        "ffprobe",
-        "-v", "error",
-        "-select_streams", "a:0",
-        "-show_entries", "stream=codec_name",
-        "-of", "json",
-        url
-    ]
 
-    try:
-        out = subprocess.check_output(cmd, timeout=timeout)
-        data = json.loads(out)
-        audio_codec = data["streams"][0]["codec_name"]
-        log.info(f"Audio codec: {audio_codec}")
-        return audio_codec
-    except Exception:
-        return None
+
+def movie_source(movie):
+    """
+    URL a movie plays from: a presigned URL for movies uploaded to S3, its
+    direct_source otherwise. Catalog records are never modified.
+    """
+    if movie.get("s3_hashed_name"):
+        return presigned_urls.get(movie["s3_hashed_name"])
+    return movie.get("direct_source")
 
 
-def stream_ffmpeg(cmd, content_type="video/mp4"):
+def detect_audio_codec(url, key=None, timeout=5):
     """
-    Executa FFmpeg i fa streaming del stdout cap al client
+    Audio codec of url from the probe cache, running ffprobe on a miss.
     """
+    result = probe_cache.probe(key or url, url, timeout=timeout)
+    audio_codec = result.get("audio_codec") if result else None
+    log.info(f"Audio codec: {audio_codec}")
+    return audio_codec
+
 
-    process = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL,
-        bufsize=10**6
+def needs_transcode(audio_codec, range_header, user_agent):
+    """
+    Browsers and VLC play eac3 fine, but most TVs don't. Range requests are
+    seeks on an already started playback, so they're never transcoded.
+    """
+    return (
+        (not range_header) and
+        audio_codec in ("eac3", ) and
+        not any(x in user_agent.lower() for x in ("mozilla", "vlc"))
     )
 
-    def generate():
-        try:
-            while True:
-                chunk = process.stdout.read(8192)
-                if not chunk:
-                    break
-                yield chunk
-        finally:
-            process.kill()
 
-    return Response(
-        generate(),
+def stream_ffmpeg(cmd, content_type="video/mp4", key=None, session=None):
+    """
+    Executa FFmpeg i fa streaming del stdout cap al client, compartint el
+    procés amb els clients que demanen el mateix stream
+    """
+
+    try:
+        client = transcodes.open(key or " ".join(cmd), cmd)
+    except TranscodeBusy:
+        release_session(session)
+        return "Too many transcodes in progress, try again later", 503
+
+    response = Response(
+        client,
         content_type=content_type,
         headers={
             "Cache-Control": "no-cache",
             "Accept-Ranges": "bytes"
         }
     )
+    response.call_on_close(lambda: release_session(session))
+    return response
 
 
 def ffmpeg_transcode_audio(src_url):
@@ -245,32 +438,31 @@ def ffmpeg_transcode_audio(src_url):
     ]
 
 
-def stream_remote(url):
-    r = requests.get(url, stream=True)
+def release_session(session):
+    if session is not None:
+        streams.release(session)
 
-    log.info(f"Streaming remote from: {url}")
 
-    def generate():
-        chunks_streamed = 0
-        chunk_size = 256*1024  # 256KB
-        try:
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    chunks_streamed += 1
-                    if chunks_streamed % 40 == 0:
-                        log.info(f"Streamed {chunks_streamed} chunks ({chunks_streamed * chunk_size / 1024 / 1024:.2f} MB) from {url}")  # noqa
-                    yield chunk
-        finally:
-            r.close()
+def stream_remote(url, session=None, channel=None):
+    try:
+        relay = relays.get(url, channel=channel)
+    except requests.RequestException as e:
+        release_session(session)
+        log.info(f"Error opening upstream {url}: {e}")
+        return "Upstream unavailable", 502
 
-    return Response(
-        generate(),
-        content_type=r.headers.get("Content-Type", "video/mp2t"),
+    log.info(f"Streaming remote from: {url}")
+
+    response = Response(
+        relay.iter_client(),
+        content_type=relay.content_type,
         headers={
             "Cache-Control": "no-cache",
             "Transfer-Encoding": "chunked"
         }
     )
+    response.call_on_close(lambda: release_session(session))
+    return response
 
 
 @app.route("/movie/<username>/<password>/<int:stream_id>.<extension>")
@@ -287,66 +479,94 @@ def proxy_movie(username, password, stream_id=None, extension=None):
     range_header = request.headers.get("Range")
     log.info(f"MOVIE. User agent: {ua_header}, Range: {range_header}")
 
-    for movie in CONFIG['movie_streams']:
-        if movie['stream_id'] == stream_id:
-            if movie.get("s3_hashed_name"):
-                set_or_update_presigned_url(movie)
-            redirect_url = movie['direct_source']
-            if not range_header:
-                audio_codec = detect_audio_codec(redirect_url)
-            break
+    movie = CATALOG["store"].movie(stream_id)
+    if movie:
+        redirect_url = movie_source(movie)
+        if not range_header:
+            # codecs probed by create_data.py, or probed now and cached
+            audio_codec = movie.get("audio_codec") or detect_audio_codec(
+                redirect_url, key=movie.get("s3_hashed_name")
+            )
 
     if not redirect_url:
         return "Stream not found", 404
 
-    transcode = (
-        (not range_header) and
-        audio_codec in ("eac3", ) and
-        not any(x in ua_header.lower() for x in ("mozilla", "vlc"))
-    )
-
-    if transcode:
+    if needs_transcode(audio_codec, range_header, ua_header):
+        try:
+            session = streams.acquire(username, "movie", stream_id)
+        except StreamLimitReached as e:
+            return str(e), e.status
         log.info(f"Transcoding from url: {redirect_url}")
         return stream_ffmpeg(
             ffmpeg_transcode_audio(redirect_url),
-            content_type="video/mp4"
+            content_type="video/mp4",
+            key=f"movie_{stream_id}",
+            session=session
         )
-    else:
-        return Response(
-            f"Redirecting to {redirect_url}", status=302,
-            headers={"Location": redirect_url}
+
+    if vod_cache is not None:
+        cached = vod_cache.open(
+            movie_cache_key(movie), redirect_url, range_header
         )
+        if cached is not None:
+            try:
+                session = streams.acquire(username, "movie", stream_id)
+            except StreamLimitReached as e:
+                cached.close()
+                return str(e), e.status
+            log.info(f"Serving movie {stream_id} from the VOD cache")
+            return serve_cached_range(cached, session)
+
+    return Response(
+        f"Redirecting to {redirect_url}", status=302,
+        headers={"Location": redirect_url}
+    )
+
+
+def movie_cache_key(movie):
+    return cache_key(movie.get("s3_hashed_name") or movie["direct_source"])
+
+
+def serve_cached_range(cached, session=None):
+    # passed through as is, so the server closes cached, not the response
+    cached.on_close = lambda: release_session(session)
+    # the file wrapper lets servers that support it use sendfile
+    return Response(
+        wrap_file(request.environ, cached),
+        status=206 if cached.partial else 200,
+        content_type=cached.content_type,
+        headers=cached.headers(),
+        direct_passthrough=True
+    )
 
 
 @app.route("/<username>/<password>/<int:stream_id>")
 @app.route("/live/<username>/<password>/<int:stream_id>.ts")
+@app.route("/live/<username>/<password>/<int:stream_id>.m3u8")
 def proxy_live(username, password, stream_id=None):
     if not check_login(username, password):
         return "Unauthorized", 401
 
     log.info(f"Requested live stream: {stream_id}")
 
-    redirect_url = None
-    category_id = None
-
-    for live in CONFIG['live_streams']:
-        if live['stream_id'] == stream_id:
-            redirect_url = live['direct_source']
-            name = live.get('name')
-            category_id = live.get('category_id')
-            break
-
-    if not redirect_url:
+    catalog = CATALOG
+    live = catalog["store"].live(stream_id)
+    if not live or not live.get('direct_source'):
         return "Stream not found", 404
 
-    category_ids = [
-        live.get('category_id')
-        for live in CONFIG['live_streams'] if live.get('name') == name
-    ]
+    redirect_url = live['direct_source']
+    category_id = live.get('category_id')
 
-    if any(c in CONFIG.get("proxy_categories", []) for c in category_ids if c):
+    if catalog["store"].is_proxied(stream_id) and hls_source(redirect_url):
+        log.info(f"Proxying HLS live stream {stream_id} in category {category_id}")  # noqa
+        return serve_hls_playlist(redirect_url, username, password, stream_id)
+    elif catalog["store"].is_proxied(stream_id):
+        try:
+            session = streams.acquire(username, "live", stream_id)
+        except StreamLimitReached as e:
+            return str(e), e.status
         log.info(f"Proxying live stream {stream_id} in category {category_id}")
-        return stream_remote(redirect_url)
+        return stream_remote(redirect_url, session, channel=str(stream_id))
     else:
         log.info(f"Sending redirect URL {redirect_url} for live stream {stream_id} in category {category_id}")
         return Response(
@@ -355,38 +575,396 @@ def proxy_live(username, password, stream_id=None):
         )
 
 
+def hls_source(url):
+    return CONFIG.get("hls", {}).get("enabled", True) and is_hls(url)
+
+
+def serve_hls_playlist(url, username, password, stream_id):
+    try:
+        playlist = hls.playlist(
+            url, f"/hls/{username}/{password}/{stream_id}"
+        )
+    except Exception as e:
+        log.info(f"Error fetching HLS playlist {url}: {e}")
+        return "Upstream unavailable", 502
+    return Response(
+        playlist, content_type=hls.content_type("m3u8"),
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
+# Playlists and segments of proxied HLS channels, as rewritten by
+# serve_hls_playlist(). HLS viewers hold no connection open, so they don't
+# take stream sessions.
+@app.route("/hls/<username>/<password>/<int:stream_id>/<name>")
+def proxy_hls(username, password, stream_id, name):
+    if not check_login(username, password):
+        return "Unauthorized", 401
+
+    match = re.match(r"^([a-f0-9]{20})\.([a-z0-9]{1,5})$", name)
+    if not match:
+        return "400 Invalid filename", 400
+    token, extension = match.groups()
+
+    live = CATALOG["store"].live(stream_id)
+    if not live or not CATALOG["store"].is_proxied(stream_id):
+        return "Stream not found", 404
+
+    if extension == "m3u8":
+        url = hls.playlist_url(token)
+        if url is None:
+            return "Playlist not found", 404
+        return serve_hls_playlist(url, username, password, stream_id)
+
+    try:
+        body = hls.segment(token)
+    except Exception as e:
+        log.info(f"Error fetching HLS segment {token}: {e}")
+        return "Upstream unavailable", 502
+    if body is None:
+        return "Segment not found", 404
+    return Response(
+        body, content_type=hls.content_type(extension),
+        headers={"Cache-Control": f"max-age={hls.segment_ttl}"}
+    )
+
+
 @app.route("/xmltv.php")
 def xmltv():
-    epg = '<?xml version="1.0" encoding="UTF-8"?><tv></tv>'
-    return Response(epg, content_type="application/xml")
+    epg_file = CONFIG.get("epg", {}).get("file", "xmltv.xml.gz")
+    if not os.path.exists(epg_file):
+        return Response(EMPTY_XMLTV, content_type="application/xml")
+
+    # the guide is written gzipped by create_data.py and sent as is
+    if request.accept_encodings["gzip"]:
+        response = send_file(
+            os.path.abspath(epg_file), mimetype="application/xml",
+            conditional=True
+        )
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+    def chunks():
+        with gzip.open(epg_file, "rb") as f:
+            yield from iter(lambda: f.read(64 * 1024), b"")
+    return Response(chunks(), content_type="application/xml")
 
 
 @app.route("/logos/<path:filename>")
 def logos(filename):
-    if not re.match(r"^[a-f0-9]{32}\.[a-z]{3,4}$", filename):
+    if not re.match(r"^(custom_)?[a-f0-9]{32,40}\.[a-z]{3,4}$", filename):
         return "400 Invalid filename", 400
-    else:
-        return send_from_directory("logos", filename)
+
+    logo = logo_store.get(filename)
+    if logo is None:
+        return "Logo not found", 404
+
+    # normalized logos are named after their content, they never change
+    max_age = 365*24*3600 if logo["immutable"] else 24*3600
+    headers = {
+        "ETag": f'"{logo["etag"]}"',
+        "Cache-Control": f"public, max-age={max_age}"
+        + (", immutable" if logo["immutable"] else ""),
+    }
+    if request.if_none_match.contains(logo["etag"]):
+        return Response(status=304, headers=headers)
+    return Response(
+        logo["body"], content_type=logo["content_type"], headers=headers
+    )
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if not CONFIG.get("metrics", True):
+        return "Not found", 404
+    return Response(
+        metrics.render((collect_streams, collect_caches, collect_catalog)),
+        content_type="text/plain; version=0.0.4"
+    )
+
+
+# streams, caches and the catalog are read from their own counters, only
+# when scraped
+def collect_streams():
+    render = metrics.render_samples
+    stream_stats = streams.stats()
+    relay_stats = list(relays.stats().values())
+    transcode_stats = transcodes.stats()
+    relayed = sorted(relays.bytes_by_channel().items())
+    return (
+        render("xtreamer_streams_active", "Streams holding a session.",
+               "gauge", [((), stream_stats["active"])]) +
+        render("xtreamer_streams_rejected_total",
+               "Streams rejected by the stream caps.",
+               "counter", [((), stream_stats["rejected"])]) +
+        render("xtreamer_relays_active", "Live channels being relayed.",
+               "gauge", [((), len(relay_stats))]) +
+        render("xtreamer_relay_clients", "Clients of relayed channels.",
+               "gauge", [((), sum(r["clients"] for r in relay_stats))]) +
+        render("xtreamer_relay_bytes_total",
+               "Bytes relayed per channel, read upstream (in) and sent to "
+               "clients (out).", "counter",
+               [((channel, "in"), b[0]) for channel, b in relayed] +
+               [((channel, "out"), b[1]) for channel, b in relayed],
+               ("channel", "direction")) +
+        render("xtreamer_transcodes_active", "ffmpeg processes running.",
+               "gauge", [((), transcode_stats["active"])]) +
+        render("xtreamer_transcodes_queued",
+               "Transcodes waiting for an ffmpeg slot.",
+               "gauge", [((), transcode_stats["queued"])]) +
+        render("xtreamer_transcodes_total", "Finished transcodes.",
+               "counter", [((), transcode_stats["total_transcodes"])]) +
+        render("xtreamer_transcode_bytes_total",
+               "Bytes output by finished transcodes.",
+               "counter", [((), transcode_stats["total_bytes_out"])]) +
+        render("xtreamer_transcode_cpu_seconds_total",
+               "CPU time used by finished transcodes.",
+               "counter", [((), transcode_stats["total_cpu_time"])])
+    )
+
+
+def collect_caches():
+    render = metrics.render_samples
+    lines = []
+    if presigned_urls is not None:
+        presigned = presigned_urls.stats()
+        lines += render(
+            "xtreamer_presigned_url_requests_total",
+            "Presigned URL requests, served cached (hit) or signed (miss).",
+            "counter",
+            [(("hit",), presigned["hits"]), (("miss",), presigned["misses"])],
+            ("result",)
+        ) + render(
+            "xtreamer_presigned_url_entries", "Presigned URLs cached.",
+            "gauge", [((), presigned["entries"])]
+        )
+    logo_stats = logo_store.stats()
+    lines += render(
+        "xtreamer_logo_requests_total", "Logo requests per cache result.",
+        "counter",
+        [(("hit",), logo_stats["hits"]), (("miss",), logo_stats["misses"])],
+        ("result",)
+    ) + render(
+        "xtreamer_logo_cache_bytes", "Bytes of logos held in memory.",
+        "gauge", [((), logo_stats["bytes"])]
+    )
+    hls_stats = hls.stats()
+    lines += render(
+        "xtreamer_hls_segment_requests_total",
+        "HLS segment requests, served cached (hit), sharing another "
+        "request fetch (joined) or fetched (miss).", "counter",
+        [(("hit",), hls_stats["hits"]), (("joined",), hls_stats["joined"]),
+         (("miss",), hls_stats["misses"])],
+        ("result",)
+    ) + render(
+        "xtreamer_hls_playlist_fetches_total",
+        "HLS playlists fetched upstream.",
+        "counter", [((), hls_stats["playlist_fetches"])]
+    ) + render(
+        "xtreamer_hls_bytes_total",
+        "HLS bytes fetched upstream and served to clients.", "counter",
+        [(("upstream",), hls_stats["upstream_bytes"]),
+         (("served",), hls_stats["served_bytes"])],
+        ("direction",)
+    ) + render(
+        "xtreamer_hls_cache_bytes", "Bytes of HLS segments cached.",
+        "gauge", [(("memory",), hls_stats["bytes"]),
+                  (("disk",), hls_stats["disk_bytes"])],
+        ("tier",)
+    )
+    if vod_cache is not None:
+        vod_stats = vod_cache.stats()
+        lines += render(
+            "xtreamer_vod_cache_requests_total",
+            "Movie requests served from the VOD cache (hit) or origin.",
+            "counter",
+            [(("hit",), vod_stats["hits"]), (("miss",), vod_stats["misses"])],
+            ("result",)
+        ) + render(
+            "xtreamer_vod_cache_bytes_total",
+            "Bytes served from the VOD cache and copied into it.", "counter",
+            [(("served",), vod_stats["served_bytes"]),
+             (("filled",), vod_stats["filled_bytes"])],
+            ("direction",)
+        ) + render(
+            "xtreamer_vod_cache_size_bytes", "Bytes of movies on disk.",
+            "gauge", [((), vod_stats["bytes"])]
+        )
+    return lines
+
+
+def collect_catalog():
+    render = metrics.render_samples
+    catalog = CATALOG
+    if not catalog:
+        return []
+    store = catalog["store"]
+    return (
+        render("xtreamer_catalog_records", "Records in the catalog per list.",
+               "gauge", [((key,), store.count(key)) for key in CATALOG_KEYS],
+               ("list",)) +
+        render("xtreamer_catalog_load_seconds",
+               "Time the last catalog load took.",
+               "gauge", [((), catalog.get("load_seconds", 0))]) +
+        render("xtreamer_response_cache_bytes",
+               "Bytes of pre-serialized player_api responses.",
+               "gauge", [((), catalog.get("responses_bytes", 0))]) +
+        render("xtreamer_epg_channels", "Channels in the guide index.",
+               "gauge", [((), len(catalog["epg"]))])
+    )
+
+
+def build_catalog(data=None, store=None):
+    """
+    Build a catalog snapshot from the stream data, or from an SQLite
+    catalog: the store handlers look streams up in, plus the response
+    cache for the request hot paths.
+    """
+    start = time()
+    if store is None:
+        store = MemoryCatalog(
+            data, CONFIG.get("proxy_categories", []),
+            compact=CONFIG.get("compact_catalog", True)
+        )
+    catalog = {"store": store, "version": None, "epg": ProgrammeIndex({})}
+    if not store.in_memory:
+        catalog["version"] = store.version()
+    log.info(
+        f"Indexed {store.count('live_streams')} live streams and "
+        f"{store.count('movie_streams')} movies in {time() - start:.2f}s"
+    )
+
+    if not CONFIG.get("response_cache", True):
+        catalog["responses"] = {}
+        catalog["responses_bytes"] = 0
+        return catalog
+
+    start = time()
+    catalog["responses"] = build_response_cache(store)
+    cache_size = sum(
+        len(body)
+        for entry in catalog["responses"].values()
+        for body in entry["encodings"].values()
+    )
+    catalog["responses_bytes"] = cache_size
+    log.info(
+        f"Built response cache in {time() - start:.2f}s "
+        f"({cache_size / 1024 / 1024:.2f} MB)"
+    )
+    return catalog
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except Exception:
+        return 0.0
+
+
+def epg_index_mtime():
+    index_file = CONFIG.get("epg", {}).get("index_file", "epg_index.json")
+    return os.path.getmtime(index_file) if os.path.exists(index_file) \
+        else None
+
+
+def load_epg_index():
+    index_file = CONFIG.get("epg", {}).get("index_file", "epg_index.json")
+    mtime = epg_index_mtime()
+    if mtime is None:
+        return ProgrammeIndex({}), None
+    index = ProgrammeIndex(datafile.load(index_file))
+    log.info(f"Loaded guide of {len(index)} channels from {index_file}")
+    return index, mtime
 
 
 def load_stream_data():
+    global CATALOG
+
     json_data_file = CONFIG.get('json_data_file', 'final_data.json')
     if not json_data_file or not os.path.exists(json_data_file):
-        log.info("No existing stream data file found: ", json_data_file)
+        log.info(f"No existing stream data file found: {json_data_file}")
         sys.exit(1)
 
-    with open(json_data_file) as f:
-        data = json.load(f)
-        CONFIG["live_streams"] = data.get("live_streams", [])
-        CONFIG["movie_streams"] = data.get("movie_streams", [])
-        CONFIG["series_streams"] = data.get("series_streams", [])
-        CONFIG["live_categories"] = data.get("live_categories", [])
-        CONFIG["movie_categories"] = data.get("movie_categories", [])
-        CONFIG["series_categories"] = data.get("series_categories", [])
+    start = time()
+    rss_before = rss_mb()
+    mtime = os.path.getmtime(json_data_file)
+    store = sqlite_catalog(CONFIG)
+    data = None
+    if store is None:
+        data = datafile.load(json_data_file, keys=CATALOG_KEYS)
+    elif store.meta("source") != mtime:
+        # the data file changed since it was imported
+        store.import_data(
+            datafile.load(json_data_file, keys=CATALOG_KEYS), source=mtime
+        )
 
+    catalog = build_catalog(data, store)
+    catalog["mtime"] = mtime
+    catalog["epg"], catalog["epg_mtime"] = load_epg_index()
+    catalog["load_seconds"] = time() - start
+    CATALOG = catalog
+    del data
+
+    log.info(
+        f"Loaded {json_data_file} in {time() - start:.2f}s, "
+        f"RSS {rss_before:.1f} MB -> {rss_mb():.1f} MB (old snapshot is "
+        f"freed once requests using it finish)"
+    )
+
+
+def watch_stream_data(interval=5):
+    """
+    Reload the stream data when json_data_file, the SQLite catalog or the
+    guide index change, or on SIGHUP. A failed reload (e.g. the file is
+    still being written) keeps the current catalog until it changes again.
+    """
+    json_data_file = CONFIG.get('json_data_file', 'final_data.json')
+    last_mtime = (CATALOG.get("mtime"), CATALOG.get("epg_mtime"))
+    while True:
+        requested = reload_requested.wait(timeout=interval)
+        reload_requested.clear()
+        try:
+            mtime = (os.path.getmtime(json_data_file), epg_index_mtime())
+            # the utils importers write straight to the SQLite catalog
+            store = CATALOG["store"]
+            imported = not store.in_memory and \
+                store.version() != CATALOG["version"]
+            if not requested and mtime == last_mtime and not imported:
+                continue
+            last_mtime = mtime
+            log.info(f"Reloading stream data from {json_data_file}")
+            load_stream_data()
+        except (Exception, SystemExit) as e:
+            log.info(f"Error reloading {json_data_file}, keeping current catalog: {e}")  # noqa
+
+
+def start_reload_watcher():
+    interval = CONFIG.get("reload_interval", 5)
+    if not interval:
+        return
+    try:
+        signal.signal(signal.SIGHUP, lambda *_: reload_requested.set())
+    except (AttributeError, ValueError):
+        # no SIGHUP on windows, or not in the main thread
+        pass
+    threading.Thread(
+        target=watch_stream_data, args=(interval,),
+        name="reload-watcher", daemon=True
+    ).start()
+
+
+def setup(config_file):
+    """
+    Load the config file and the stream data, and set up the shared state
+    used by both the Flask and the ASGI servers. Returns the port to listen
+    on.
+    """
+    global CONFIG, s3, relays, hls, transcodes, probe_cache, logo_store, \
+        presigned_urls, vod_cache
 
-if __name__ == "__main__":
-    config_file = sys.argv[1] if len(sys.argv) > 1 else "config.json"
     with open(config_file) as f:
         CONFIG = json.load(f)
 
@@ -401,6 +979,8 @@ if __name__ == "__main__":
         log.info("Error: No credentials set in config.json!")
         exit(1)
 
+    load_credentials()
+
     s3 = boto3.client(
         "s3",
         aws_access_key_id=CONFIG.get("s3_uploads", {}).get("aws", {}).get("aws_access_key_id"),  # noqa
@@ -408,9 +988,45 @@ if __name__ == "__main__":
         region_name=CONFIG.get("s3_uploads", {}).get("aws", {}).get("region_name"),  # noqa
     )
 
+    presigned_urls = PresignedUrls(presign_s3_key, **{
+        "cache_file": "presigned_urls.json",
+        **CONFIG.get("presigned_urls", {})
+    })
+    presigned_urls.start()
+    atexit.register(presigned_urls.stop)
+
+    relays = RelayManager(**CONFIG.get("relay", {}))
+    hls = HlsProxy(**{
+        k: v for k, v in CONFIG.get("hls", {}).items() if k != "enabled"
+    })
+    transcodes = TranscodeManager(**CONFIG.get("transcode", {}))
+    probe_cache = ProbeCache(
+        cache_file=CONFIG.get("probe", {}).get("cache_file", "probe_cache.json"),  # noqa
+        ttl=CONFIG.get("probe", {}).get("ttl", 7*24*3600),
+        save_interval=CONFIG.get("probe", {}).get("save_interval", 30),
+    )
+    # results probed since the last save
+    atexit.register(probe_cache.save)
+
+    vod_cache_config = CONFIG.get("vod_cache", {})
+    if vod_cache_config.get("enabled"):
+        vod_cache = VodCache(**{
+            k: v for k, v in vod_cache_config.items() if k != "enabled"
+        })
+
+    logo_store = LogoStore(
+        max_bytes=CONFIG.get("logos", {}).get("cache_mb", 32) * 1024 * 1024
+    )
+
     load_stream_data()
+    start_reload_watcher()
 
-    port = \
+    return \
         int(CONFIG['base_url'].split(":")[-1]) \
         if ":" in CONFIG['base_url'] else 8080
+
+
+if __name__ == "__main__":
+    config_file = sys.argv[1] if len(sys.argv) > 1 else "config.json"
+    port = setup(config_file)
     app.run(host="0.0.0.0", port=port, debug=False)
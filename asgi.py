@@ -0,0 +1,439 @@
+import re
+import io
+import sys
+import asyncio
+import threading
+import logging
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import uvicorn
+
+import app as xtreamer
+from relay import AsyncRelayManager
+from transcode import AsyncTranscodeManager, TranscodeBusy
+from sessions import StreamLimitReached
+import metrics
+
+
+# ASGI server for the same routes as app.py. Live and movie streams are
+# served natively with asyncio (relays read upstream with a non-blocking
+# HTTP client, ffmpeg output is read through asyncio pipes), so every
+# viewer costs a coroutine instead of a thread. Everything else is cheap
+# and handed to the Flask app in a small thread pool.
+#   python3 asgi.py my_config.json
+
+log = logging.getLogger(__name__)
+
+relays = None
+transcodes = None
+wsgi_executor = ThreadPoolExecutor(max_workers=16)
+# chunks of a Flask response pulled ahead of the client
+WSGI_QUEUE_CHUNKS = 8
+
+# with the Flask rule they stand for, to label their metrics the same
+LIVE_ROUTES = (
+    (re.compile(r"^/live/([^/]+)/([^/]+)/(\d+)\.ts$"),
+     "/live/<username>/<password>/<int:stream_id>.ts"),
+    (re.compile(r"^/live/([^/]+)/([^/]+)/(\d+)\.m3u8$"),
+     "/live/<username>/<password>/<int:stream_id>.m3u8"),
+    (re.compile(r"^/([^/]+)/([^/]+)/(\d+)$"),
+     "/<username>/<password>/<int:stream_id>"),
+)
+MOVIE_ROUTE = re.compile(r"^/movie/([^/]+)/([^/]+)/(\d+)(?:\.([^/]+))?$")
+MOVIE_RULES = (
+    "/movie/<username>/<password>/<int:stream_id>",
+    "/movie/<username>/<password>/<int:stream_id>.<extension>",
+)
+
+
+async def send_response(send, status, body=b"", headers=()):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (k.lower().encode("latin-1"), v.encode("latin-1"))
+            for k, v in headers
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_redirect(send, url):
+    await send_response(
+        send, 302, f"Redirecting to {url}", headers=[("Location", url)]
+    )
+
+
+async def stream_response(receive, send, chunks, content_type, headers=(),
+                          status=200):
+    """
+    Send chunks to the client until they run out or the client goes away,
+    closing chunks either way so relays and transcodes see the detach.
+    """
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type.encode("latin-1")),
+            (b"cache-control", b"no-cache"),
+        ] + [
+            (k.lower().encode("latin-1"), v.encode("latin-1"))
+            for k, v in headers
+        ],
+    })
+    await send_chunks(receive, send, chunks)
+
+
+async def send_chunks(receive, send, chunks):
+    """
+    Send the response body from chunks until they run out or the client
+    goes away, closing chunks either way.
+    """
+    async def pump():
+        async for chunk in chunks:
+            await send({
+                "type": "http.response.body", "body": chunk,
+                "more_body": True
+            })
+        await send({"type": "http.response.body", "body": b""})
+
+    async def wait_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    tasks = [
+        asyncio.create_task(pump()),
+        asyncio.create_task(wait_disconnect())
+    ]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                log.info(f"Error sending response: {result!r}")
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+        else:
+            chunks.close()
+
+
+def request_headers(scope):
+    return {
+        k.decode("latin-1").lower(): v.decode("latin-1")
+        for k, v in scope["headers"]
+    }
+
+
+async def acquire_session(username, kind, stream_id):
+    # waiting for a free slot (queue_timeout) blocks, keep it off the loop
+    if not xtreamer.streams.queue_timeout:
+        return xtreamer.streams.acquire(username, kind, stream_id)
+    return await asyncio.to_thread(
+        xtreamer.streams.acquire, username, kind, stream_id
+    )
+
+
+async def proxy_live(scope, receive, send, username, password, stream_id):
+    if not xtreamer.check_login(username, password):
+        return await send_response(send, 401, "Unauthorized")
+
+    catalog = xtreamer.CATALOG
+    live = catalog["store"].live(stream_id)
+    if not live or not live.get('direct_source'):
+        return await send_response(send, 404, "Stream not found")
+
+    url = live['direct_source']
+    if not catalog["store"].is_proxied(stream_id):
+        return await send_redirect(send, url)
+    if xtreamer.hls_source(url):
+        # a rewritten playlist, the segments it lists are cheap requests
+        return await flask_fallback(scope, receive, send, timed=True)
+
+    try:
+        session = await acquire_session(username, "live", stream_id)
+    except StreamLimitReached as e:
+        return await send_response(send, e.status, str(e))
+
+    try:
+        try:
+            relay = await relays.get(url, channel=str(stream_id))
+        except httpx.HTTPError as e:
+            log.info(f"Error opening upstream {url}: {e}")
+            return await send_response(send, 502, "Upstream unavailable")
+
+        await stream_response(
+            receive, send, relay.iter_client(), relay.content_type
+        )
+    finally:
+        xtreamer.streams.release(session)
+
+
+async def read_cached(cached, chunk_size=256*1024):
+    # no sendfile in ASGI, the file is read off the loop
+    try:
+        while True:
+            chunk = await asyncio.to_thread(cached.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        cached.close()
+
+
+async def proxy_movie(scope, receive, send, username, password, stream_id):
+    if not xtreamer.check_login(username, password):
+        return await send_response(send, 401, "Unauthorized")
+
+    movie = xtreamer.CATALOG["store"].movie(stream_id)
+    if not movie:
+        return await send_response(send, 404, "Stream not found")
+
+    headers = request_headers(scope)
+    user_agent = headers.get("user-agent", "").lower()
+    range_header = headers.get("range")
+
+    url = xtreamer.movie_source(movie)
+
+    audio_codec = None
+    if not range_header:
+        audio_codec = movie.get("audio_codec") or await asyncio.to_thread(
+            xtreamer.detect_audio_codec, url, key=movie.get("s3_hashed_name")
+        )
+
+    if not xtreamer.needs_transcode(audio_codec, range_header, user_agent):
+        if xtreamer.vod_cache is not None:
+            cached = await asyncio.to_thread(
+                xtreamer.vod_cache.open, xtreamer.movie_cache_key(movie),
+                url, range_header
+            )
+            if cached is not None:
+                try:
+                    session = await acquire_session(
+                        username, "movie", stream_id
+                    )
+                except StreamLimitReached as e:
+                    cached.close()
+                    return await send_response(send, e.status, str(e))
+                try:
+                    return await stream_response(
+                        receive, send, read_cached(cached),
+                        cached.content_type,
+                        headers=cached.headers().items(),
+                        status=206 if cached.partial else 200
+                    )
+                finally:
+                    xtreamer.streams.release(session)
+        return await send_redirect(send, url)
+
+    try:
+        session = await acquire_session(username, "movie", stream_id)
+    except StreamLimitReached as e:
+        return await send_response(send, e.status, str(e))
+
+    try:
+        try:
+            client = await transcodes.open(
+                f"movie_{stream_id}", xtreamer.ffmpeg_transcode_audio(url)
+            )
+        except TranscodeBusy:
+            return await send_response(
+                send, 503, "Too many transcodes in progress, try again later"
+            )
+        await stream_response(
+            receive, send, client, "video/mp4",
+            headers=[("Accept-Ranges", "bytes")]
+        )
+    finally:
+        xtreamer.streams.release(session)
+
+
+def wsgi_environ(scope, body, timed=False):
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": "",
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": (scope.get("server") or ("localhost", 0))[0],
+        "SERVER_PORT": str((scope.get("server") or ("localhost", 80))[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        # already timed by a native route, see timed()
+        "xtreamer.timed": timed,
+    }
+    for name, value in request_headers(scope).items():
+        key = name.upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = f"HTTP_{key}"
+        environ[key] = value
+    return environ
+
+
+def run_wsgi(environ, loop, queue, stopped):
+    """
+    Run the Flask app for environ and pull its whole body on this thread,
+    as some bodies can't move between threads (SQLite cursors of streamed
+    lists). (status, headers), then each chunk, then None are put in
+    queue; an exception raised by the app is put instead. Pulling stops
+    once stopped is set, and waits while queue is full.
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    result = None
+    try:
+        result = xtreamer.app.wsgi_app(environ, start_response)
+        put((response["status"], response["headers"]))
+        for chunk in result:
+            if stopped.is_set():
+                return
+            if chunk:
+                put(chunk)
+        put(None)
+    except Exception as e:
+        if not stopped.is_set():
+            put(e)
+    finally:
+        # runs the Flask call_on_close callbacks (stream sessions)
+        if hasattr(result, "close"):
+            result.close()
+
+
+async def wsgi_chunks(queue, stopped):
+    """
+    The body of a WSGI response, as run_wsgi() puts it in queue, so
+    streamed responses (big lists, the TV guide) are sent as they're
+    produced instead of being joined first.
+    """
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop_wsgi(queue, stopped)
+
+
+def stop_wsgi(queue, stopped):
+    # the client may be gone, let run_wsgi() finish a pending put
+    stopped.set()
+    while not queue.empty():
+        queue.get_nowait()
+
+
+async def flask_fallback(scope, receive, send, timed=False):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+
+    queue = asyncio.Queue(maxsize=WSGI_QUEUE_CHUNKS)
+    stopped = threading.Event()
+    wsgi_executor.submit(
+        run_wsgi, wsgi_environ(scope, body, timed),
+        asyncio.get_running_loop(), queue, stopped
+    )
+    try:
+        first = await queue.get()
+        if isinstance(first, Exception):
+            raise first
+        status, headers = first
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (k.lower().encode("latin-1"), v.encode("latin-1"))
+                for k, v in headers
+            ],
+        })
+    except BaseException:
+        stop_wsgi(queue, stopped)
+        raise
+    await send_chunks(receive, send, wsgi_chunks(queue, stopped))
+
+
+def timed(send, rule):
+    """
+    send, observing the time to the response headers of rule.
+    """
+    started = perf_counter()
+
+    async def timed_send(message):
+        if message["type"] == "http.response.start":
+            metrics.REQUEST_SECONDS.observe(perf_counter() - started, rule)
+        await send(message)
+    return timed_send
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await relays.client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    path = scope["path"]
+    if scope["method"] in ("GET", "HEAD"):
+        match = MOVIE_ROUTE.match(path)
+        if match:
+            username, password, stream_id, extension = match.groups()
+            send = timed(send, MOVIE_RULES[extension is not None])
+            return await proxy_movie(
+                scope, receive, send, username, password, int(stream_id)
+            )
+        for route, rule in LIVE_ROUTES:
+            match = route.match(path)
+            if match and not path.startswith("/logos/"):
+                username, password, stream_id = match.groups()
+                send = timed(send, rule)
+                return await proxy_live(
+                    scope, receive, send, username, password, int(stream_id)
+                )
+
+    await flask_fallback(scope, receive, send)
+
+
+if __name__ == "__main__":
+    config_file = sys.argv[1] if len(sys.argv) > 1 else "config.json"
+    port = xtreamer.setup(config_file)
+
+    relays = AsyncRelayManager(
+        httpx.AsyncClient(
+            timeout=httpx.Timeout(10, read=30),
+            limits=httpx.Limits(max_connections=None)
+        ),
+        **xtreamer.CONFIG.get("relay", {})
+    )
+    transcodes = AsyncTranscodeManager(**xtreamer.CONFIG.get("transcode", {}))
+    # /metrics is served by the Flask app, which never streams here
+    xtreamer.relays = relays
+    xtreamer.transcodes = transcodes
+
+    uvicorn.run(application, host="0.0.0.0", port=port, log_level="warning")
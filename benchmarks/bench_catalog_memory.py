@@ -0,0 +1,50 @@
+import gc
+import os
+import sys
+import json
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from catalog_store import MemoryCatalog  # noqa: E402
+from bench_player_api import synthetic_catalog  # noqa: E402
+
+
+# Bytes per movie held by the in-memory catalog, with records as dicts
+# and as compact records, once the loaded data is dropped.
+#   python benchmarks/bench_catalog_memory.py [sizes=100000,500000]
+
+def measure(body, compact):
+    gc.collect()
+    tracemalloc.start()
+    # parsed like load_stream_data does, so no strings are shared upfront
+    data = json.loads(body)
+    start = perf_counter()
+    catalog = MemoryCatalog(data, compact=compact)
+    build_time = perf_counter() - start
+    del data
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return catalog, size, build_time
+
+
+if __name__ == "__main__":
+    sizes = [
+        int(n) for n in
+        (sys.argv[1] if len(sys.argv) > 1 else "100000,500000").split(",")
+    ]
+
+    print(f"{'movies':>8} {'records':<8} {'total':>10} {'per movie':>10} {'build':>8}")  # noqa
+    for size in sizes:
+        body = json.dumps(synthetic_catalog(size))
+        for compact in (False, True):
+            catalog, total, build_time = measure(body, compact)
+            assert catalog.movie(size // 2)["stream_id"] == size // 2
+            print(
+                f"{size:>8} {'compact' if compact else 'dicts':<8} "
+                f"{total / 1024 / 1024:>8.1f}MB {total / size:>9.0f}B "
+                f"{build_time:>7.2f}s"
+            )
+            del catalog
@@ -0,0 +1,87 @@
+import os
+import sys
+import random
+import tempfile
+import subprocess
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app  # noqa: E402
+import datafile  # noqa: E402
+from bench_player_api import synthetic_catalog  # noqa: E402
+
+
+# RSS after loading the catalog and latency of stream lookups and
+# get_vod_info requests, for the in-memory and the SQLite catalog. Each
+# backend runs in its own process, with the response cache off so only
+# the catalog itself counts.
+#   python benchmarks/bench_catalog_store.py [movies=500000] [lookups=20000]
+
+def run_backend(backend, data_file, lookups):
+    app.CONFIG.update({
+        "credentials": [{"username": "u", "password": "p"}],
+        "json_data_file": data_file,
+        "catalog_backend": backend,
+        "catalog_db": os.path.join(os.path.dirname(data_file), "catalog.db"),
+        "response_cache": False,
+    })
+    app.load_credentials()
+    rss_before = app.rss_mb()
+    start = perf_counter()
+    app.load_stream_data()
+    load_time = perf_counter() - start
+    rss = app.rss_mb() - rss_before
+
+    store = app.CATALOG["store"]
+    movies = store.count("movie_streams")
+    ids = [random.randint(1, movies) for _ in range(lookups)]
+    start = perf_counter()
+    for stream_id in ids:
+        store.movie(stream_id)
+    lookup_time = (perf_counter() - start) / lookups
+
+    client = app.app.test_client()
+    start = perf_counter()
+    for stream_id in ids[:2000]:
+        client.get(
+            "/player_api.php?username=u&password=p&action=get_vod_info"
+            f"&vod_id={stream_id}"
+        )
+    request_time = (perf_counter() - start) / min(lookups, 2000)
+
+    print(
+        f"{backend:<8} {load_time:>8.2f}s {rss:>9.1f}MB "
+        f"{lookup_time * 1e6:>9.1f}us {request_time * 1e6:>9.1f}us"
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--backend":
+        run_backend(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        sys.exit(0)
+
+    movies = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    lookups = sys.argv[2] if len(sys.argv) > 2 else "20000"
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ext = datafile.PACKED_EXT if datafile.msgpack else ".json"
+        data_file = os.path.join(tmp_dir, f"final_data{ext}")
+        datafile.dump(synthetic_catalog(movies), data_file)
+
+        print(f"{movies} movies")
+        print(
+            f"{'backend':<8} {'load':>9} {'RSS':>11} {'lookup':>11} "
+            f"{'vod_info':>11}"
+        )
+        for backend in ("memory", "sqlite"):
+            # the first sqlite run imports the data file, the second one
+            # opens the existing database, as after a restart
+            for _ in range(2 if backend == "sqlite" else 1):
+                subprocess.run(
+                    [sys.executable, __file__, "--backend", backend,
+                     data_file, lookups],
+                    check=True,
+                    env=dict(os.environ, PYTHONWARNINGS="ignore"),
+                    stderr=subprocess.DEVNULL,
+                )
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import resource
+import tempfile
+import subprocess
+
+
+# Concurrent proxied live streams served by the Flask server (app.py) vs
+# the ASGI server (asgi.py): how many clients get data, and the server's
+# threads and RSS while they're all connected.
+#   python benchmarks/bench_concurrent_streams.py [clients=50,200,1000]
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+UPSTREAM_PORT = 18170
+SERVER_PORT = 18171
+TS_CHUNK = b"\x47" + b"\x00" * 187
+
+
+async def upstream(reader, writer):
+    # endless fake mpeg-ts channel, ~2 Mbps
+    await reader.readuntil(b"\r\n\r\n")
+    writer.write(
+        b"HTTP/1.1 200 OK\r\nContent-Type: video/mp2t\r\n"
+        b"Connection: close\r\n\r\n"
+    )
+    try:
+        while True:
+            writer.write(TS_CHUNK * 70)
+            await writer.drain()
+            await asyncio.sleep(0.05)
+    except (Exception, asyncio.CancelledError):
+        writer.close()
+
+
+def proc_status(pid):
+    status = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            status[key] = (value.split() or [""])[0]
+    return int(status["Threads"]), int(status["VmRSS"]) / 1024
+
+
+async def viewer(results, hold):
+    try:
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", SERVER_PORT
+        )
+        writer.write(
+            b"GET /live/u/p/1.ts HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        )
+        await writer.drain()
+        received = 0
+        while received < 64 * 1024:
+            data = await reader.read(65536)
+            if not data:
+                break
+            received += len(data)
+        results.append(received >= 64 * 1024)
+        await hold.wait()
+        writer.close()
+    except Exception:
+        results.append(False)
+
+
+async def run(mode, clients, pid):
+    results = []
+    hold = asyncio.Event()
+    tasks = [
+        asyncio.create_task(viewer(results, hold)) for _ in range(clients)
+    ]
+    start = time.time()
+    while len(results) < clients and time.time() - start < 60:
+        await asyncio.sleep(0.2)
+    elapsed = time.time() - start
+    threads, rss = proc_status(pid)
+    hold.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    print(
+        f"{mode:<6} {clients:>6} clients: {sum(results):>6} streaming after "
+        f"{elapsed:5.1f}s, {threads:>5} threads, {rss:7.1f} MB RSS"
+    )
+    await asyncio.sleep(2)
+
+
+async def main(client_counts):
+    server = await asyncio.start_server(upstream, "127.0.0.1", UPSTREAM_PORT)
+    workdir = tempfile.mkdtemp()
+    data_file = os.path.join(workdir, "data.json")
+    config_file = os.path.join(workdir, "config.json")
+    with open(data_file, "w") as f:
+        json.dump({
+            "live_categories": [{"category_id": "c", "category_name": "c"}],
+            "live_streams": [{
+                "num": 1, "name": "Channel", "stream_id": 1,
+                "category_id": "c",
+                "direct_source": f"http://127.0.0.1:{UPSTREAM_PORT}/1"
+            }],
+        }, f)
+    with open(config_file, "w") as f:
+        json.dump({
+            "base_url": f"http://127.0.0.1:{SERVER_PORT}",
+            "credentials": [{"username": "u", "password": "p"}],
+            "json_data_file": data_file,
+            "proxy_categories": ["c"],
+        }, f)
+
+    for mode, script in (("flask", "app.py"), ("asgi", "asgi.py")):
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, script), config_file],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        await asyncio.sleep(3)
+        try:
+            for clients in client_counts:
+                await run(mode, clients, process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+
+    server.close()
+
+
+if __name__ == "__main__":
+    client_counts = [
+        int(n) for n in
+        (sys.argv[1] if len(sys.argv) > 1 else "50,200,1000").split(",")
+    ]
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    asyncio.run(main(client_counts))
@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import datafile  # noqa: E402
+from bench_player_api import synthetic_catalog  # noqa: E402
+
+
+# Size, write time and load time of a data file as JSON (indent=4, as
+# create_data.py writes it) and packed, plus loading only the live streams
+# section of the packed file.
+#   python benchmarks/bench_datafile.py [movies=500000]
+
+def timed(function, *args, **kwargs):
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    return result, perf_counter() - start
+
+
+if __name__ == "__main__":
+    movies = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    data = synthetic_catalog(movies)
+
+    print(f"{movies} movies")
+    print(f"{'format':<14} {'size':>10} {'write':>9} {'load':>9}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in ("data.json", "data.pack"):
+            path = os.path.join(tmp_dir, name)
+            _, write_time = timed(datafile.dump, data, path)
+            loaded, load_time = timed(datafile.load, path)
+            assert loaded == data, f"{name} doesn't round trip"
+            print(
+                f"{name:<14} {os.path.getsize(path) / 1024 / 1024:>8.1f}MB "
+                f"{write_time:>8.2f}s {load_time:>8.2f}s"
+            )
+
+        _, section_time = timed(
+            datafile.load, os.path.join(tmp_dir, "data.pack"),
+            keys=("live_streams", "live_categories")
+        )
+        print(f"{'pack, lives':<14} {'':>10} {'':>9} {section_time:>8.2f}s")
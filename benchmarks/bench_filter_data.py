@@ -0,0 +1,158 @@
+import os
+import sys
+import random
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from create_data import filter_data  # noqa: E402
+
+
+# filter_data on a synthetic upstream catalog, against the previous
+# implementation (any() over every category and rule for every stream).
+#   python benchmarks/bench_filter_data.py [streams=100000] [categories=2000]
+
+COUNTRIES = [
+    "ES", "UK", "FR", "DE", "IT", "PT", "NL", "US", "AR", "TR", "PL", "RU",
+    "CA", "MX", "BR", "SE", "NO", "DK", "FI", "GR",
+]
+WHITELIST = [f"{c} | " for c in ("ES", "PT")] + [
+    f"{c} | SPORTS" for c in COUNTRIES
+] + ["VOD | SPAIN", "VOD | ES", "4K | ES"]
+CUSTOM_LIVE_CATS = {
+    "futbol": {
+        "channel_has": ["LaLiga", "Premier League", "Serie A", "Bundesliga"],
+        "channel_startswith": ["DAZN F1", "M+ LIGA"],
+    },
+    "cine": {
+        "channel_has": ["Cinema", "Movies"],
+        "channel_startswith": ["TCM", "AXN"],
+    },
+    "kids": {
+        "channel_has": ["Disney", "Cartoon", "Nick"],
+    },
+}
+WORDS = [
+    "Sports", "News", "Cinema", "LaLiga", "Movies", "Music", "Kids", "HD",
+    "FHD", "4K", "Premier League", "Disney", "Documentary", "Series", "TCM",
+]
+
+
+def synthetic_upstream(streams, categories, seed=1):
+    rng = random.Random(seed)
+    live_categories = [
+        {
+            "category_id": str(i),
+            "category_name": f"{rng.choice(COUNTRIES)} | "
+                             f"{rng.choice(WORDS).upper()} {i}",
+            "parent_id": 0,
+        }
+        for i in range(categories)
+    ]
+    live_streams = [
+        {
+            "num": i,
+            "name": f"{rng.choice(COUNTRIES)}: {rng.choice(WORDS)} "
+                    f"{rng.choice(WORDS)} {i}",
+            "stream_type": "live",
+            "stream_id": i,
+            "stream_icon": "",
+            "epg_channel_id": None,
+            "category_id": str(rng.randrange(categories)),
+        }
+        for i in range(streams)
+    ]
+    movie_streams = [
+        {
+            "num": i,
+            "name": f"Movie {i}",
+            "stream_type": "movie",
+            "stream_id": i,
+            "category_id": str(rng.randrange(categories)),
+            "container_extension": "mkv",
+        }
+        for i in range(streams)
+    ]
+    return {
+        "ep": {
+            "live_categories": live_categories,
+            "live_streams": live_streams,
+            "movie_categories": [dict(c) for c in live_categories],
+            "movie_streams": movie_streams,
+            "series_categories": [],
+            "series_streams": [],
+        }
+    }
+
+
+def filter_data_reference(ep_data, whitelisted_grups=[], custom_live_cats={}):
+    result = {}
+
+    channel_starts_with = []
+    channel_has = []
+    for _, rules in custom_live_cats.items():
+        channel_starts_with.extend(rules.get("channel_startswith", []))
+        channel_has.extend(rules.get("channel_has", []))
+
+    for ep_name in ep_data:
+        data = ep_data[ep_name]
+        result[ep_name] = {}
+        result[ep_name]["live_categories"] = [
+            cat for cat in data["live_categories"]
+            if any(
+                cat["category_name"].lower().startswith(w.lower())
+                for w in whitelisted_grups
+            )
+        ]
+        result[ep_name]["live_streams"] = [
+            stream for stream in data["live_streams"]
+            if any(
+                stream["category_id"] == cat["category_id"]
+                for cat in result[ep_name]["live_categories"]
+            ) or any(
+                stream["name"].lower().startswith(match_name.lower())
+                for match_name in channel_starts_with
+            ) or any(
+                match_name.lower() in stream["name"].lower()
+                for match_name in channel_has
+            )
+        ]
+        result[ep_name]["movie_categories"] = [
+            cat for cat in data["movie_categories"]
+            if any(
+                cat["category_name"].lower().startswith(w.lower())
+                for w in whitelisted_grups
+            )
+        ]
+        result[ep_name]["movie_streams"] = [
+            stream for stream in data["movie_streams"]
+            if any(
+                stream["category_id"] == cat["category_id"]
+                for cat in result[ep_name]["movie_categories"]
+            )
+        ]
+        result[ep_name]["series_streams"] = []
+        result[ep_name]["series_categories"] = []
+    return result
+
+
+if __name__ == "__main__":
+    streams = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    categories = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    upstream = synthetic_upstream(streams, categories)
+
+    start = perf_counter()
+    expected = filter_data_reference(upstream, WHITELIST, CUSTOM_LIVE_CATS)
+    reference_time = perf_counter() - start
+
+    start = perf_counter()
+    result = filter_data(upstream, WHITELIST, CUSTOM_LIVE_CATS)
+    compiled_time = perf_counter() - start
+
+    assert result == expected, "filter_data output differs from reference"
+    print(
+        f"{streams} live streams + {streams} movies, {categories} categories:"
+        f" {len(result['ep']['live_streams'])} live streams kept"
+    )
+    print(f"reference any() loops: {reference_time:8.2f}s")
+    print(f"compiled matchers:     {compiled_time:8.2f}s")
@@ -0,0 +1,83 @@
+import os
+import sys
+from time import process_time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app  # noqa: E402
+
+
+# CPU time per player_api list request: jsonify on every call vs. the
+# pre-serialized response cache built by load_stream_data.
+#   python benchmarks/bench_player_api.py [movies=150000] [requests=20]
+
+def synthetic_catalog(movies):
+    return {
+        "live_categories": [],
+        "live_streams": [],
+        "movie_categories": [
+            {"category_id": f"ep_{i}", "category_name": f"VOD | {i}"}
+            for i in range(200)
+        ],
+        "movie_streams": [
+            {
+                "num": i,
+                "name": f"Movie number {i} (2024)",
+                "stream_type": "movie",
+                "stream_id": i,
+                "stream_icon": f"http://img.example.com/posters/{i}.jpg",
+                "rating": "6.5",
+                "rating_5based": 3.25,
+                "added": "1700000000",
+                "category_id": f"ep_{i % 200}",
+                "container_extension": "mkv",
+                "custom_sid": "",
+                "direct_source": f"http://iptv:8080/movie/u/p/{i}.mkv",
+            }
+            for i in range(1, movies + 1)
+        ],
+        "series_categories": [],
+        "series_streams": [],
+    }
+
+
+def run(client, n, headers):
+    start = process_time()
+    for _ in range(n):
+        response = client.get(
+            "/player_api.php?username=u&password=p&action=get_vod_streams",
+            headers=headers
+        )
+        response.get_data()
+    return (process_time() - start) / n
+
+
+if __name__ == "__main__":
+    movies = int(sys.argv[1]) if len(sys.argv) > 1 else 150000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    app.CONFIG["credentials"] = [{"username": "u", "password": "p"}]
+    app.load_credentials()
+    app.CATALOG = app.build_catalog(synthetic_catalog(movies))
+    client = app.app.test_client()
+
+    responses = app.CATALOG["responses"]
+    app.CATALOG["responses"] = {}
+    jsonify_cpu = run(client, n, {})
+
+    start = process_time()
+    app.build_response_cache(app.CATALOG["store"])
+    build_cpu = process_time() - start
+    app.CATALOG["responses"] = responses
+
+    identity_cpu = run(client, n, {})
+    gzip_cpu = run(client, n, {"Accept-Encoding": "gzip"})
+
+    entry = app.CATALOG["responses"]["get_vod_streams"]
+    print(f"{movies} movies, {n} requests per mode")
+    print(f"jsonify per request:       {jsonify_cpu * 1000:9.2f} ms CPU")
+    print(f"cached identity per req:   {identity_cpu * 1000:9.2f} ms CPU")
+    print(f"cached gzip per request:   {gzip_cpu * 1000:9.2f} ms CPU")
+    print(f"one-off cache build:       {build_cpu * 1000:9.2f} ms CPU")
+    for enc, body in entry["encodings"].items():
+        print(f"  {enc:<9} {len(body) / 1024 / 1024:8.2f} MB")
@@ -0,0 +1,159 @@
+import os
+import sys
+import copy
+import json
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from create_data import filter_data, process_data  # noqa: E402
+from bench_filter_data import (  # noqa: E402
+    synthetic_upstream, WHITELIST, CUSTOM_LIVE_CATS
+)
+
+
+# process_data on a synthetic multi-endpoint catalog, against the previous
+# implementation (linear scan of the categories for every stream). The
+# output must be identical; with --golden FILE it's also compared with (or,
+# if FILE doesn't exist yet, saved to) a golden file.
+#   python benchmarks/bench_process_data.py [streams=50000] [endpoints=3]
+#       [--golden FILE]
+
+def process_data_reference(data, endpoints_info, custom_live_cats={}):
+    def live_url(stream_id, endpoint_info):
+        return \
+            f"{endpoint_info['url']}/" \
+            f"{endpoint_info['user']}/{endpoint_info['pass']}/{stream_id}"
+
+    def movie_url(stream_id, endpoint_info, ext="mp4"):
+        return \
+            f"{endpoint_info['url']}/movie/" \
+            f"{endpoint_info['user']}/{endpoint_info['pass']}/" \
+            f"{stream_id}.{ext}"
+
+    result = {
+        "live_categories": [
+            {"category_id": k, "category_name": k}
+            for k in custom_live_cats.keys()
+        ],
+        "live_streams": [],
+        "movie_categories": [],
+        "movie_streams": [],
+        "series_categories": [],
+        "series_streams": []
+    }
+    global_live_stream_id = 1
+    global_movie_stream_id = 1
+
+    for ep_name, ep_data in data.items():
+        suffix = endpoints_info[ep_name].get("suffix", "")
+        for live_cat in ep_data['live_categories']:
+            new_cat_id = f"{ep_name}_{live_cat['category_id']}"
+            live_cat['category_id'] = new_cat_id
+            new_parent_id = f"{ep_name}_{live_cat.get('parent_id', '')}"
+            live_cat['parent_id'] = new_parent_id
+            live_cat['category_name'] += suffix
+            result["live_categories"].append(live_cat)
+
+        for live_stream in ep_data['live_streams']:
+            new_cat_id = f"{ep_name}_{live_stream['category_id']}"
+            if any(
+                _category.get("category_id") == new_cat_id
+                for _category in result["live_categories"]
+            ):
+                live_stream['category_id'] = new_cat_id
+                live_stream["direct_source"] = \
+                    live_url(live_stream['stream_id'], endpoints_info[ep_name])
+                live_stream["stream_id"] = global_live_stream_id
+                live_stream["num"] = global_live_stream_id
+                live_stream["name"] += suffix
+                global_live_stream_id += 1
+                result["live_streams"].append(live_stream)
+
+            for category, match_rules_dict in custom_live_cats.items():
+                channel_startswith = \
+                    match_rules_dict.get("channel_startswith", [])
+                channel_has = \
+                    match_rules_dict.get("channel_has", [])
+                if any(
+                    live_stream["name"].lower().startswith(match_name.lower())
+                    for match_name in channel_startswith
+                ) or any(
+                    match_name.lower() in live_stream["name"].lower()
+                    for match_name in channel_has
+                ):
+                    dup_live_stream = live_stream.copy()
+                    dup_live_stream["category_id"] = category
+                    dup_live_stream["stream_id"] = global_live_stream_id
+                    dup_live_stream["num"] = global_live_stream_id
+                    global_live_stream_id += 1
+                    result["live_streams"].append(dup_live_stream)
+
+        for movie_cat in ep_data['movie_categories']:
+            new_cat_id = f"{ep_name}_{movie_cat['category_id']}"
+            movie_cat['category_id'] = new_cat_id
+            movie_cat['category_name'] += suffix
+            result["movie_categories"].append(movie_cat)
+
+        for movie_stream in ep_data['movie_streams']:
+            new_cat_id = f"{ep_name}_{movie_stream['category_id']}"
+            movie_stream['category_id'] = new_cat_id
+            ext = movie_stream.get("container_extension", "mp4")
+            movie_stream["direct_source"] = \
+                movie_url(
+                    movie_stream['stream_id'], endpoints_info[ep_name], ext)
+            movie_stream["stream_id"] = global_movie_stream_id
+            movie_stream["num"] = global_movie_stream_id
+            global_movie_stream_id += 1
+            result["movie_streams"].append(movie_stream)
+
+    return result
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    golden_file = None
+    if "--golden" in args:
+        golden_file = args[args.index("--golden") + 1]
+        del args[args.index("--golden"):args.index("--golden") + 2]
+    streams = int(args[0]) if len(args) > 0 else 50000
+    endpoints = int(args[1]) if len(args) > 1 else 3
+
+    upstream = {}
+    endpoints_info = {}
+    for i in range(endpoints):
+        ep_name = f"ep{i}"
+        upstream[ep_name] = synthetic_upstream(streams, 2000, seed=i)["ep"]
+        endpoints_info[ep_name] = {
+            "url": f"http://provider{i}:8080", "user": "u", "pass": "p",
+            "suffix": f" [{i}]" if i else ""
+        }
+    filtered = filter_data(upstream, WHITELIST, CUSTOM_LIVE_CATS)
+
+    reference_input = copy.deepcopy(filtered)
+    start = perf_counter()
+    expected = process_data_reference(
+        reference_input, endpoints_info, CUSTOM_LIVE_CATS)
+    reference_time = perf_counter() - start
+
+    start = perf_counter()
+    result = process_data(filtered, endpoints_info, CUSTOM_LIVE_CATS)
+    new_time = perf_counter() - start
+
+    assert result == expected, "process_data output differs from reference"
+    if golden_file:
+        if os.path.exists(golden_file):
+            with open(golden_file) as f:
+                assert json.load(f) == result, "output differs from golden"
+            print(f"Output matches golden file {golden_file}")
+        else:
+            with open(golden_file, "w") as f:
+                json.dump(result, f, indent=4)
+            print(f"Saved golden file {golden_file}")
+
+    print(
+        f"{endpoints} endpoints, {len(result['live_streams'])} live streams, "
+        f"{len(result['movie_streams'])} movies processed"
+    )
+    print(f"reference scans:  {reference_time:8.2f}s")
+    print(f"single pass:      {new_time:8.2f}s")
@@ -0,0 +1,66 @@
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app  # noqa: E402
+from bench_player_api import synthetic_catalog  # noqa: E402
+
+
+# Peak memory allocated per get_vod_streams request and time to first byte
+# for jsonify, the streaming serializer (stream_json) and the response
+# cache.
+#   python benchmarks/bench_streaming_json.py [sizes=10000,100000,500000]
+
+def request(client):
+    start = perf_counter()
+    response = client.get(
+        "/player_api.php?username=u&password=p&action=get_vod_streams",
+        buffered=False
+    )
+    chunks = iter(response.response)
+    next(chunks)
+    ttfb = perf_counter() - start
+    for _ in chunks:
+        pass
+    total = perf_counter() - start
+    response.close()
+    return ttfb, total
+
+
+def measure(client):
+    # timings without tracemalloc, it slows allocations down a lot
+    ttfb, total = request(client)
+    tracemalloc.start()
+    request(client)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ttfb, total, peak
+
+
+if __name__ == "__main__":
+    sizes = [
+        int(n) for n in
+        (sys.argv[1] if len(sys.argv) > 1 else "10000,100000,500000").split(",")  # noqa
+    ]
+
+    app.CONFIG["credentials"] = [{"username": "u", "password": "p"}]
+    app.load_credentials()
+    client = app.app.test_client()
+
+    print(f"{'movies':>8} {'mode':<8} {'TTFB':>10} {'total':>10} {'peak alloc':>12}")  # noqa
+    for size in sizes:
+        app.CONFIG["response_cache"] = True
+        app.CATALOG = app.build_catalog(synthetic_catalog(size))
+        responses = app.CATALOG["responses"]
+
+        for mode in ("jsonify", "stream", "cached"):
+            app.CATALOG["responses"] = responses if mode == "cached" else {}
+            app.CONFIG["stream_json"] = mode == "stream"
+            ttfb, total, peak = measure(client)
+            print(
+                f"{size:>8} {mode:<8} {ttfb * 1000:>8.1f}ms "
+                f"{total * 1000:>8.1f}ms {peak / 1024 / 1024:>10.2f}MB"
+            )
@@ -0,0 +1,387 @@
+import json
+import sqlite3
+import threading
+
+
+# Catalog backends. Request handlers look streams up through the same small
+# interface whether the catalog is kept in memory (the default) or in an
+# indexed SQLite database, which keeps big VOD catalogs out of the Python
+# heap at the cost of a query per lookup.
+
+CATALOG_KEYS = (
+    "live_streams", "movie_streams", "series_streams",
+    "live_categories", "movie_categories", "series_categories",
+)
+
+
+def serialize(record):
+    return json.dumps(
+        record, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def iter_json_list(bodies, batch_size=500):
+    """
+    Join serialized records as a JSON array batch by batch, so only one
+    batch is held in memory at a time.
+    """
+    yield b"["
+    separator = b""
+    batch = []
+    for body in bodies:
+        batch.append(body)
+        if len(batch) == batch_size:
+            yield separator + b",".join(batch)
+            separator = b","
+            batch = []
+    if batch:
+        yield separator + b",".join(batch)
+    yield b"]"
+
+
+def build_catalog_index(data, proxy_categories=()):
+    """
+    Index streams by stream_id and live channel names by the categories
+    they appear in, and precompute which live streams must be proxied.
+    """
+    live_categories_by_name = {}
+    for live in data.get("live_streams", []):
+        category_id = live.get("category_id")
+        if category_id:
+            live_categories_by_name.setdefault(
+                live.get("name"), set()).add(category_id)
+
+    # a channel is proxied if any of its copies (same name) lives in a
+    # proxied category, i.e. custom categories inherit it
+    proxy_categories = set(proxy_categories)
+    proxied_names = {
+        name for name, category_ids in live_categories_by_name.items()
+        if category_ids & proxy_categories
+    }
+
+    return {
+        "lives": {
+            live["stream_id"]: live for live in data.get("live_streams", [])
+        },
+        "movies": {
+            movie["stream_id"]: movie
+            for movie in data.get("movie_streams", [])
+        },
+        "live_categories_by_name": live_categories_by_name,
+        "proxied_lives": {
+            live["stream_id"] for live in data.get("live_streams", [])
+            if live.get("name") in proxied_names
+        },
+    }
+
+
+class CompactRecords:
+    """
+    Records of a catalog list as tuples: the key tuple of the record
+    (shared by every record with the same keys, in the same order)
+    followed by its values. Equal strings (category ids, container
+    extensions, ratings...) are stored once across the whole catalog.
+    Records are only turned back into dicts when they're read.
+    """
+
+    __slots__ = ("rows",)
+
+    def __init__(self, records, shapes, strings):
+        intern = strings.setdefault
+        self.rows = rows = []
+        for record in records:
+            keys = tuple(record)
+            shape = shapes.get(keys) or shapes.setdefault(keys, keys)
+            rows.append((shape, *[
+                intern(value, value) if value.__class__ is str else value
+                for value in record.values()
+            ]))
+
+    @staticmethod
+    def materialize(row):
+        return dict(zip(row[0], row[1:]))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return map(self.materialize, self.rows)
+
+
+class MemoryCatalog:
+    """
+    Catalog lists as loaded from the data file, plus indexes by stream id.
+    With compact, records are kept as CompactRecords instead of dicts.
+    """
+
+    in_memory = True
+
+    def __init__(self, data, proxy_categories=(), compact=True):
+        self.lists = {key: data.get(key, []) for key in CATALOG_KEYS}
+        index = build_catalog_index(self.lists, proxy_categories)
+        self.proxied_lives = index["proxied_lives"]
+        self.lives = index["lives"]
+        self.movies = index["movies"]
+        self.compact = compact
+
+        if compact:
+            shapes, strings = {}, {}
+            for key, records in self.lists.items():
+                compacted = CompactRecords(records, shapes, strings)
+                if key == "live_streams":
+                    self.lives = self._index(records, compacted)
+                elif key == "movie_streams":
+                    self.movies = self._index(records, compacted)
+                self.lists[key] = compacted
+
+    @staticmethod
+    def _index(records, compacted):
+        return {
+            record["stream_id"]: row
+            for record, row in zip(records, compacted.rows)
+        }
+
+    def _record(self, rows, stream_id):
+        row = rows.get(stream_id)
+        if row is None or not self.compact:
+            return row
+        return CompactRecords.materialize(row)
+
+    def live(self, stream_id):
+        return self._record(self.lives, stream_id)
+
+    def movie(self, stream_id):
+        return self._record(self.movies, stream_id)
+
+    def is_proxied(self, stream_id):
+        return stream_id in self.proxied_lives
+
+    def count(self, key):
+        return len(self.lists[key])
+
+    def _records(self, key, category_id=None):
+        records = self.lists[key]
+        if category_id is None:
+            return iter(records)
+        return (
+            r for r in records if str(r.get("category_id")) == category_id
+        )
+
+    def records(self, key, category_id=None):
+        return list(self._records(key, category_id))
+
+    def serialized(self, key):
+        """
+        (category_id, JSON body) of every record in key, in order.
+        """
+        for record in self.lists[key]:
+            yield str(record.get("category_id")), serialize(record)
+
+    def iter_json(self, key, category_id=None):
+        return iter_json_list(
+            serialize(record) for record in self._records(key, category_id)
+        )
+
+
+class SqliteCatalog:
+    """
+    Catalog in an SQLite database, one row per record with its JSON and the
+    columns it's looked up by. Every thread reads through its own
+    connection; WAL mode lets them keep reading while a writer (a reload or
+    one of the utils importers) replaces or extends the catalog in a
+    single transaction.
+    """
+
+    in_memory = False
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS records (
+            list TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            stream_id INTEGER,
+            category_id TEXT,
+            name TEXT,
+            record TEXT NOT NULL,
+            PRIMARY KEY (list, position)
+        );
+        CREATE INDEX IF NOT EXISTS records_stream_id
+            ON records (list, stream_id, position);
+        CREATE INDEX IF NOT EXISTS records_category_id
+            ON records (list, category_id, position);
+        CREATE INDEX IF NOT EXISTS records_name
+            ON records (list, name, category_id);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, db_file, proxy_categories=()):
+        self.db_file = db_file
+        self.proxy_categories = [str(c) for c in proxy_categories]
+        self._local = threading.local()
+        db = self.connect()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(self.SCHEMA)
+        db.close()
+
+    def connect(self):
+        db = sqlite3.connect(self.db_file, timeout=30)
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    @property
+    def db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self.connect()
+        return db
+
+    def _record(self, key, stream_id):
+        # the last one wins on duplicated ids, as in MemoryCatalog
+        row = self.db.execute(
+            "SELECT record FROM records WHERE list = ? AND stream_id = ? "
+            "ORDER BY position DESC LIMIT 1", (key, stream_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def live(self, stream_id):
+        return self._record("live_streams", stream_id)
+
+    def movie(self, stream_id):
+        return self._record("movie_streams", stream_id)
+
+    def is_proxied(self, stream_id):
+        if not self.proxy_categories:
+            return False
+        # any copy of the channel (same name) in a proxied category
+        row = self.db.execute(
+            "SELECT 1 FROM records AS copy JOIN records AS live "
+            "ON copy.list = live.list AND copy.name = live.name "
+            "WHERE live.list = 'live_streams' AND live.stream_id = ? "
+            "AND copy.category_id IN "
+            f"({','.join('?' * len(self.proxy_categories))}) LIMIT 1",
+            (stream_id, *self.proxy_categories)
+        ).fetchone()
+        return row is not None
+
+    def count(self, key):
+        return self.db.execute(
+            "SELECT count(*) FROM records WHERE list = ?", (key,)
+        ).fetchone()[0]
+
+    def _rows(self, key, category_id=None):
+        if category_id is None:
+            return self.db.execute(
+                "SELECT category_id, record FROM records WHERE list = ? "
+                "ORDER BY position", (key,)
+            )
+        return self.db.execute(
+            "SELECT category_id, record FROM records WHERE list = ? AND "
+            "category_id = ? ORDER BY position", (key, category_id)
+        )
+
+    def records(self, key, category_id=None):
+        return [json.loads(record) for _, record in self._rows(
+            key, category_id
+        )]
+
+    def serialized(self, key):
+        for category_id, record in self._rows(key):
+            yield category_id, record.encode("utf-8")
+
+    def iter_json(self, key, category_id=None):
+        return iter_json_list(
+            record.encode("utf-8")
+            for _, record in self._rows(key, category_id)
+        )
+
+    def meta(self, key, default=None):
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def version(self):
+        """
+        Bumped by every write, so readers know when to refresh what they
+        derived from the catalog.
+        """
+        return self.meta("version", 0)
+
+    def _insert(self, db, key, records, first_position):
+        db.executemany(
+            "INSERT INTO records (list, position, stream_id, category_id, "
+            "name, record) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    key, position, record.get("stream_id"),
+                    str(record.get("category_id")), record.get("name"),
+                    serialize(record).decode("utf-8")
+                )
+                for position, record in enumerate(records, first_position)
+            )
+        )
+
+    def _set_meta(self, db, key, value):
+        db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, json.dumps(value))
+        )
+
+    def _bump_version(self, db):
+        row = db.execute(
+            "SELECT value FROM meta WHERE key = 'version'"
+        ).fetchone()
+        self._set_meta(db, "version", (json.loads(row[0]) if row else 0) + 1)
+
+    def import_data(self, data, source=None):
+        """
+        Replace the whole catalog with data, in one transaction. source
+        identifies where it comes from (e.g. the data file mtime).
+        """
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM records")
+            for key in CATALOG_KEYS:
+                self._insert(db, key, data.get(key, []), 0)
+            self._set_meta(db, "source", source)
+            self._bump_version(db)
+        db.close()
+
+    def add_records(self, append={}, prepend={}):
+        """
+        Add records to the end (append) or the start (prepend) of lists,
+        given as {key: records}, in one transaction.
+        """
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            for key, records in append.items():
+                last = db.execute(
+                    "SELECT max(position) FROM records WHERE list = ?",
+                    (key,)
+                ).fetchone()[0]
+                self._insert(db, key, records, 0 if last is None else last + 1)
+            for key, records in prepend.items():
+                first = db.execute(
+                    "SELECT min(position) FROM records WHERE list = ?",
+                    (key,)
+                ).fetchone()[0]
+                self._insert(
+                    db, key, records, (first or 0) - len(records)
+                )
+            self._bump_version(db)
+        db.close()
+
+
+def sqlite_catalog(config):
+    """
+    The SQLite catalog configured in config, or None if the catalog is kept
+    in memory.
+    """
+    if config.get("catalog_backend", "memory") != "sqlite":
+        return None
+    return SqliteCatalog(
+        config.get("catalog_db", "catalog.db"),
+        config.get("proxy_categories", [])
+    )
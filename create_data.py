@@ -1,55 +1,175 @@
 from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from probe import ProbeCache
+from matcher import PrefixTrie, ChannelRules
+from logos import LogoFetcher, normalize_logos
+import datafile
+from epg import (
+    channels_digest, write_fragments, merge_fragments
+)
+from time import time, sleep
 import requests
+import urllib3
 import hashlib
 import os
 import json
 import sys
 
-
-# Just fetch data from endpoints, data is saved as is, no changes.
-def fetch_from_endpoint(endpoint_info):
-    ep_url = \
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# a truncated or broken body (JSON decoding errors are ValueErrors)
+BODY_ERRORS = (
+    requests.RequestException, urllib3.exceptions.HTTPError, ValueError
+) + ((ijson.JSONError, ) if ijson else ())
+
+
+# upstream player_api action for each list in the stage files
+FETCH_ACTIONS = {
+    "live_categories": "get_live_categories",
+    "live_streams": "get_live_streams",
+    "movie_categories": "get_vod_categories",
+    "movie_streams": "get_vod_streams",
+    "series_categories": "get_series_categories",
+    "series_streams": "get_series",
+}
+
+
+def http_session(retries=3, pool_size=10):
+    """
+    Pooled session retrying failed connections and 429/5xx responses with
+    exponential backoff.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=1,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", ),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_action(session, endpoint_info, action, timeout=60, retries=3):
+    """
+    Fetch one player_api action. Big lists (get_vod_streams can be hundreds
+    of MB) are parsed while downloading when ijson is installed, so the raw
+    body is never held in memory next to the decoded objects.
+    """
+    url = \
         f"{endpoint_info['url']}/player_api.php?" \
         f"username={endpoint_info['user']}&" \
         f"password={endpoint_info['pass']}&" \
-        "action="
+        f"action={action}"
+
+    for attempt in range(retries + 1):
+        try:
+            # connection errors and 429/5xx are already retried by the adapter
+            response = session.get(url, stream=True, timeout=timeout)
+        except requests.RequestException as e:
+            print(f"Error fetching {action} from {endpoint_info['url']}: {e}")  # noqa
+            return []
+        with response:
+            if response.status_code != 200:
+                return []
+            try:
+                if ijson:
+                    response.raw.decode_content = True
+                    return list(ijson.items(
+                        response.raw, "item", use_float=True))
+                return response.json()
+            except BODY_ERRORS as e:
+                # but errors reading the body aren't, fetch it all again
+                if attempt == retries:
+                    print(f"Error fetching {action} from {endpoint_info['url']}: {e}")  # noqa
+                    return []
+        sleep(2 ** attempt)
 
-    def _fetch(url, action):
-        response = requests.get(url + action)
-        if response.status_code == 200:
-            return response.json()
-        return []
+
+# Just fetch data from endpoints, data is saved as is, no changes.
+def fetch_from_endpoint(endpoint_info, session=None, executor=None):
+    session = session or http_session()
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=len(FETCH_ACTIONS))
 
     print(f"Fetching data from endpoint {endpoint_info['url']}...")
-    result = {
-        "live_categories": _fetch(ep_url, "get_live_categories"),
-        "live_streams": _fetch(ep_url, "get_live_streams"),
-        "movie_categories": _fetch(ep_url, "get_vod_categories"),
-        "movie_streams": _fetch(ep_url, "get_vod_streams"),
-        "series_categories": _fetch(ep_url, "get_series_categories"),
-        "series_streams": _fetch(ep_url, "get_series"),
+    start = time()
+
+    def _fetch(action):
+        action_start = time()
+        data = fetch_action(session, endpoint_info, action)
+        return data, time() - action_start
+
+    futures = {
+        key: executor.submit(_fetch, action)
+        for key, action in FETCH_ACTIONS.items()
     }
+    result = {}
+    timings = {}
+    for key, future in futures.items():
+        result[key], timings[key] = future.result()
+    if own_executor:
+        executor.shutdown()
 
     print(
         f"Fetched {len(result['live_streams'])} live streams with "
         f"{len(result['live_categories'])} categories and "
         f"{len(result['movie_streams'])} movies with "
         f"{len(result['movie_categories'])} categories "
-        f"from {endpoint_info['url']}."
+        f"from {endpoint_info['url']} in {time() - start:.1f}s ("
+        + ", ".join(f"{k}: {v:.1f}s" for k, v in timings.items()) + ")."
     )
 
     return result
 
 
+def fetch_all(endpoints, workers=6):
+    """
+    Fetch every enabled endpoint concurrently, sharing one pooled session
+    and a bounded pool of workers across all endpoints and actions.
+    """
+    session = http_session(pool_size=workers)
+    enabled = {}
+    for ep_name, ep_info in endpoints.items():
+        if not ep_info.get("enabled", True):
+            print(f"Skipping disabled endpoint: {ep_name}")
+            continue
+        enabled[ep_name] = ep_info
+
+    start = time()
+    # endpoints run in their own threads, their actions in the shared pool
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            ThreadPoolExecutor(max_workers=max(len(enabled), 1)) as ep_executor:  # noqa
+        futures = {
+            ep_name: ep_executor.submit(
+                fetch_from_endpoint, ep_info, session, executor)
+            for ep_name, ep_info in enabled.items()
+        }
+        upstream_data = {
+            ep_name: future.result() for ep_name, future in futures.items()
+        }
+    print(f"Fetched {len(enabled)} endpoints in {time() - start:.1f}s")
+    return upstream_data
+
+
 # Data is filtered here: the right groups and channels are selected
 def filter_data(ep_data, whitelisted_grups=[], custom_live_cats={}):
     result = {}
 
-    channel_starts_with = []
-    channel_has = []
-    for _, rules in custom_live_cats.items():
-        channel_starts_with.extend(rules.get("channel_startswith", []))
-        channel_has.extend(rules.get("channel_has", []))
+    whitelist = PrefixTrie(whitelisted_grups)
+    channel_rules = ChannelRules(custom_live_cats)
 
     for ep_name in ep_data:
         data = ep_data[ep_name]
@@ -58,43 +178,32 @@ def filter_data(ep_data, whitelisted_grups=[], custom_live_cats={}):
         # filter live categories and streams
         result[ep_name]["live_categories"] = [
             cat for cat in data["live_categories"]
-            if any(
-                cat["category_name"].lower().startswith(w.lower())
-                for w in whitelisted_grups
-            )
+            if whitelist.match(cat["category_name"])
         ]
+        live_category_ids = {
+            cat["category_id"] for cat in result[ep_name]["live_categories"]
+        }
 
         # Here we're adding channels for selected categories, BUT also
         # channels that match rules for custom categories, even if they're not
         # in a selected channel
         result[ep_name]["live_streams"] = [
             stream for stream in data["live_streams"]
-            if any(
-                stream["category_id"] == cat["category_id"]
-                for cat in result[ep_name]["live_categories"]
-            ) or any(
-                stream["name"].lower().startswith(match_name.lower())
-                for match_name in channel_starts_with
-            ) or any(
-                match_name.lower() in stream["name"].lower()
-                for match_name in channel_has
-            )
+            if stream["category_id"] in live_category_ids or
+            channel_rules.match(stream["name"])
         ]
 
         # filter movie categories and streams
         result[ep_name]["movie_categories"] = [
             cat for cat in data["movie_categories"]
-            if any(
-                cat["category_name"].lower().startswith(w.lower())
-                for w in whitelisted_grups
-            )
+            if whitelist.match(cat["category_name"])
         ]
+        movie_category_ids = {
+            cat["category_id"] for cat in result[ep_name]["movie_categories"]
+        }
         result[ep_name]["movie_streams"] = [
             stream for stream in data["movie_streams"]
-            if any(
-                stream["category_id"] == cat["category_id"]
-                for cat in result[ep_name]["movie_categories"]
-            )
+            if stream["category_id"] in movie_category_ids
         ]
         result[ep_name]["series_streams"] = []
         result[ep_name]["series_categories"] = []
@@ -109,7 +218,50 @@ def filter_data(ep_data, whitelisted_grups=[], custom_live_cats={}):
     return result
 
 
-def process_data(data, endpoints_info, custom_live_cats={}):
+def record_digest(record):
+    return hashlib.sha1(
+        json.dumps(record, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def allocate_id(id_map, kind, key, digest, stats):
+    """
+    Stable id for an upstream record, keyed by endpoint and upstream
+    stream_id: known records keep their id, new ones get the next free id.
+    Ids of records gone upstream are never reused.
+    """
+    ids = id_map.setdefault(kind, {})
+    entry = ids.get(key)
+    if entry is None:
+        next_key = f"next_{kind}_id"
+        entry = [id_map.get(next_key, 1), digest, 0]
+        id_map[next_key] = entry[0] + 1
+        ids[key] = entry
+        stats["new"] += 1
+    elif entry[1] != digest:
+        entry[1] = digest
+        stats["changed"] += 1
+    else:
+        stats["unchanged"] += 1
+    entry[2] = id_map["run"]
+    return entry[0]
+
+
+def process_data(data, endpoints_info, custom_live_cats={}, id_map=None):
+    """
+    Remap categories and assign our own stream ids. With a persisted
+    id_map, ids are stable across runs, otherwise streams are numbered
+    from 1.
+    """
+    # record digests only matter to report changes against a persisted map
+    track_changes = id_map is not None
+    id_map = {} if id_map is None else id_map
+    id_map["run"] = id_map.get("run", 0) + 1
+    stats = {
+        kind: {"new": 0, "changed": 0, "unchanged": 0}
+        for kind in ("live", "movie")
+    }
+
     def live_url(stream_id, endpoint_info):
         return \
             f"{endpoint_info['url']}/" \
@@ -121,6 +273,8 @@ def process_data(data, endpoints_info, custom_live_cats={}):
             f"{endpoint_info['user']}/{endpoint_info['pass']}/" \
             f"{stream_id}.{ext}"
 
+    channel_rules = ChannelRules(custom_live_cats)
+
     result = {
         "live_categories": [
             {"category_id": k, "category_name": k}
@@ -133,8 +287,9 @@ def process_data(data, endpoints_info, custom_live_cats={}):
         "series_streams": []
     }
 
-    global_live_stream_id = 1
-    global_movie_stream_id = 1
+    live_category_ids = {
+        cat["category_id"] for cat in result["live_categories"]
+    }
 
     # live
     for ep_name, ep_data in data.items():
@@ -147,43 +302,41 @@ def process_data(data, endpoints_info, custom_live_cats={}):
             live_cat['parent_id'] = new_parent_id
             live_cat['category_name'] += suffix
             result["live_categories"].append(live_cat)
+            live_category_ids.add(new_cat_id)
 
         for live_stream in ep_data['live_streams']:
+            upstream_key = f"{ep_name}|{live_stream['stream_id']}"
+            digest = record_digest(live_stream) if track_changes else None
+            # guide channels are renamed like categories, see build_epg()
+            if live_stream.get("epg_channel_id"):
+                live_stream["epg_channel_id"] = \
+                    f"{ep_name}_{live_stream['epg_channel_id']}"
             new_cat_id = f"{ep_name}_{live_stream['category_id']}"
             # that could be a channel that we want on a custom group but
             #  at same time this channel could be in a group that we dont want
-            if any(
-                _category.get("category_id") == new_cat_id
-                for _category in result["live_categories"]
-            ):
+            if new_cat_id in live_category_ids:
                 live_stream['category_id'] = new_cat_id
                 live_stream["direct_source"] = \
                     live_url(live_stream['stream_id'], endpoints_info[ep_name])
-                live_stream["stream_id"] = global_live_stream_id
-                live_stream["num"] = global_live_stream_id
+                stream_id = allocate_id(
+                    id_map, "live", upstream_key, digest, stats["live"])
+                live_stream["stream_id"] = stream_id
+                live_stream["num"] = stream_id
                 live_stream["name"] += suffix
-                global_live_stream_id += 1
                 result["live_streams"].append(live_stream)
 
             # if thats one of our custom categories, duplicate entry
-            for category, match_rules_dict in custom_live_cats.items():
-                channel_startswith = \
-                    match_rules_dict.get("channel_startswith", [])
-                channel_has = \
-                    match_rules_dict.get("channel_has", [])
-                if any(
-                    live_stream["name"].lower().startswith(match_name.lower())
-                    for match_name in channel_startswith
-                ) or any(
-                    match_name.lower() in live_stream["name"].lower()
-                    for match_name in channel_has
-                ):
-                    dup_live_stream = live_stream.copy()
-                    dup_live_stream["category_id"] = category
-                    dup_live_stream["stream_id"] = global_live_stream_id
-                    dup_live_stream["num"] = global_live_stream_id
-                    global_live_stream_id += 1
-                    result["live_streams"].append(dup_live_stream)
+            for category in \
+                    channel_rules.matching_categories(live_stream["name"]):
+                dup_live_stream = live_stream.copy()
+                dup_live_stream["category_id"] = category
+                stream_id = allocate_id(
+                    id_map, "live", f"{upstream_key}|{category}", digest,
+                    stats["live"]
+                )
+                dup_live_stream["stream_id"] = stream_id
+                dup_live_stream["num"] = stream_id
+                result["live_streams"].append(dup_live_stream)
 
         for movie_cat in ep_data['movie_categories']:
             new_cat_id = f"{ep_name}_{movie_cat['category_id']}"
@@ -192,82 +345,299 @@ def process_data(data, endpoints_info, custom_live_cats={}):
             result["movie_categories"].append(movie_cat)
 
         for movie_stream in ep_data['movie_streams']:
+            upstream_key = f"{ep_name}|{movie_stream['stream_id']}"
+            digest = record_digest(movie_stream) if track_changes else None
             new_cat_id = f"{ep_name}_{movie_stream['category_id']}"
             movie_stream['category_id'] = new_cat_id
             ext = movie_stream.get("container_extension", "mp4")
             movie_stream["direct_source"] = \
                 movie_url(
                     movie_stream['stream_id'], endpoints_info[ep_name], ext)
-            movie_stream["stream_id"] = global_movie_stream_id
-            movie_stream["num"] = global_movie_stream_id
-            global_movie_stream_id += 1
+            stream_id = allocate_id(
+                id_map, "movie", upstream_key, digest, stats["movie"])
+            movie_stream["stream_id"] = stream_id
+            movie_stream["num"] = stream_id
             result["movie_streams"].append(movie_stream)
 
+    for kind in ("live", "movie"):
+        removed = sum(
+            1 for entry in id_map.get(kind, {}).values()
+            if entry[2] == id_map["run"] - 1
+        )
+        print(
+            f"{kind.capitalize()} streams: {stats[kind]['new']} new, "
+            f"{stats[kind]['changed']} changed, "
+            f"{stats[kind]['unchanged']} unchanged, {removed} removed."
+        )
+
     return result
 
 
-def retrieve_logos(data, base_url):
-    for live_stream in data['live_streams']:
-        logo_url = live_stream.get("stream_icon", None)
-        if not logo_url:
-            continue
-        name = live_stream.get("name", "Unknown")
-        print(f"Retrieving logo for channel: {name}")
-        filename = generate_channel_logo(name, logo_url)
+def retrieve_logos(data, base_url, logos_config={}):
+    """
+    Download every distinct logo URL once, concurrently, and point channels
+    to the local copy. Channels whose logo can't be retrieved get a
+    generated one with their name.
+    """
+    start = time()
+    fetcher = LogoFetcher(
+        manifest_file=logos_config.get("manifest"),
+        workers=logos_config.get("workers", 16),
+        per_host=logos_config.get("per_host", 4),
+        max_age=logos_config.get("max_age", 24*3600),
+    )
+    logo_urls = [
+        live_stream.get("stream_icon") for live_stream in data['live_streams']
+        if (live_stream.get("stream_icon") or "").startswith("http")
+    ]
+    print(
+        f"Retrieving {len(set(logo_urls))} distinct logos for "
+        f"{len(logo_urls)} channels..."
+    )
+    filenames = fetcher.fetch_all(logo_urls)
+    print(
+        f"Logos: {fetcher.stats['downloaded']} downloaded, "
+        f"{fetcher.stats['not_modified']} not modified, "
+        f"{fetcher.stats['fresh']} fresh, {fetcher.stats['failed']} failed "
+        f"in {time() - start:.1f}s"
+    )
+
+    channels = [
+        live_stream for live_stream in data['live_streams']
+        if live_stream.get("stream_icon")
+    ]
+    missing = [
+        live_stream.get("name", "Unknown") for live_stream in channels
+        if not filenames.get(live_stream["stream_icon"])
+    ]
+    start = time()
+    placeholders = generate_channel_logos(
+        missing, workers=logos_config.get("placeholder_workers")
+    )
+    print(
+        f"Generated {len(placeholders)} placeholder logos for "
+        f"{len(missing)} channels in {time() - start:.1f}s"
+    )
+
+    for live_stream in channels:
+        filename = filenames.get(live_stream["stream_icon"]) or \
+            placeholders[live_stream.get("name", "Unknown")]
         live_stream["stream_icon"] = f"{base_url}/logos/{filename}"
 
     return data
 
 
+def logo_bytes(filenames):
+    # what a client downloads on launch, every distinct logo once
+    return sum(
+        os.path.getsize(os.path.join("./logos", filename))
+        for filename in set(filenames)
+        if os.path.exists(os.path.join("./logos", filename))
+    )
+
+
+def normalize_channel_logos(data, base_url, logos_config={}):
+    """
+    Replace channel logos with downscaled, re-encoded copies named after
+    their content, so they can be cached by clients forever.
+    """
+    start = time()
+    prefix = f"{base_url}/logos/"
+    channels = [
+        live_stream for live_stream in data['live_streams']
+        if (live_stream.get("stream_icon") or "").startswith(prefix)
+    ]
+    filenames = [c["stream_icon"][len(prefix):] for c in channels]
+    before = logo_bytes(filenames)
+
+    normalized = normalize_logos(
+        filenames,
+        max_size=logos_config.get("max_size", 256),
+        format=logos_config.get("format", "webp"),
+        workers=logos_config.get("normalize_workers", os.cpu_count() or 4),
+    )
+    for channel, filename in zip(channels, filenames):
+        channel["stream_icon"] = f"{prefix}{normalized[filename]}"
+
+    after = logo_bytes(normalized.values())
+    print(
+        f"Normalized {len(normalized)} logos in {time() - start:.1f}s, "
+        f"logo bytes per client launch: {before / 1024 / 1024:.2f}MB -> "
+        f"{after / 1024 / 1024:.2f}MB"
+    )
+    return data
+
+
+def probe_vods(data, cache_file="probe_cache.json", workers=8, timeout=10):
+    """
+    Probe every movie with ffprobe in parallel and store its codecs and
+    container, so the server doesn't need to probe at request time. Results
+    go to the same probe cache the server uses, so reruns only probe new
+    movies.
+    """
+    probe_cache = ProbeCache(cache_file=cache_file)
+    movies = [
+        movie for movie in data['movie_streams']
+        if movie.get("direct_source")
+    ]
+
+    def _probe(movie):
+        return movie, probe_cache.probe(
+            movie["direct_source"], movie["direct_source"],
+            timeout=timeout, save=False
+        )
+
+    probed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for movie, result in executor.map(_probe, movies):
+            if result:
+                movie.update(result)
+            probed += 1
+            if probed % 100 == 0:
+                print(f"Probed {probed}/{len(movies)} movies")
+                probe_cache.save()
+    probe_cache.save()
+
+    print(
+        f"Probed {len(movies)} movies, "
+        f"{sum(1 for m in movies if m.get('audio_codec'))} with audio codec."
+    )
+    return data
+
+
+def build_epg(data, endpoints_info, epg_config={}):
+    """
+    Build the XMLTV guide of the live streams in data from every endpoint
+    xmltv.php, parsed while it downloads. Endpoints whose guide didn't
+    change since the last run (conditional request) and whose channels are
+    the same reuse the fragments kept in cache_dir.
+    """
+    start = time()
+    epg_file = epg_config.get("file", "xmltv.xml.gz")
+    index_file = epg_config.get("index_file", "epg_index.json")
+    cache_dir = epg_config.get("cache_dir", "epg_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    state_file = os.path.join(cache_dir, "state.json")
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    session = http_session()
+    index = {}
+    names = []
+    for ep_name, endpoint_info in endpoints_info.items():
+        prefix = f"{ep_name}_"
+        channel_ids = {
+            live["epg_channel_id"][len(prefix):]
+            for live in data["live_streams"]
+            if (live.get("epg_channel_id") or "").startswith(prefix)
+        }
+        if not channel_ids:
+            continue
+
+        digest = channels_digest(channel_ids)
+        previous = state.get(ep_name, {})
+        ep_index_file = os.path.join(cache_dir, f"{ep_name}.index.json")
+        reusable = previous.get("channels") == digest and all(
+            os.path.exists(os.path.join(cache_dir, f"{ep_name}.{kind}"))
+            for kind in ("channels.xml.gz", "programmes.xml.gz", "index.json")
+        )
+        headers = {}
+        if reusable and previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if reusable and previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+
+        url = \
+            f"{endpoint_info['url']}/xmltv.php?" \
+            f"username={endpoint_info['user']}&" \
+            f"password={endpoint_info['pass']}"
+        ep_index = None
+        try:
+            with session.get(
+                url, headers=headers, stream=True,
+                timeout=epg_config.get("timeout", 120)
+            ) as response:
+                if response.status_code == 200:
+                    response.raw.decode_content = True
+                    ep_index = write_fragments(
+                        response.raw, channel_ids, prefix, cache_dir, ep_name
+                    )
+                    datafile.dump(ep_index, ep_index_file)
+                    state[ep_name] = {
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),  # noqa
+                        "channels": digest,
+                    }
+                    print(f"EPG of {ep_name}: {len(ep_index)} channels")
+                elif response.status_code == 304 and reusable:
+                    print(f"EPG of {ep_name} not modified")
+                else:
+                    print(f"Error fetching EPG of {ep_name}: HTTP {response.status_code}")  # noqa
+        except Exception as e:
+            print(f"Error fetching EPG of {ep_name}: {e}")
+
+        if ep_index is None and reusable:
+            ep_index = datafile.load(ep_index_file)
+        if ep_index is None:
+            continue
+        names.append(ep_name)
+        index.update(ep_index)
+
+    merge_fragments(names, cache_dir, epg_file)
+    datafile.dump(index, index_file)
+    with open(f"{state_file}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{state_file}.tmp", state_file)
+
+    print(
+        f"EPG: {len(index)} channels, "
+        f"{sum(len(p) for p in index.values())} programmes "
+        f"in {time() - start:.1f}s"
+    )
+
+
 def text_to_filename(text):
     filename = hashlib.md5(text.encode('utf-8')).hexdigest()
     filename += ".png"
     return filename
 
 
-def generate_channel_logo(text, logo_url):
-    filename = text_to_filename(text)
+# placeholder logos are rendered in worker processes, each one loads the
+# font once and keeps the sizes of the texts it measured
+PLACEHOLDER_FONT_SIZE = 48
+placeholder_font = None
 
-    # if it already exists just return the path
-    if os.path.exists('./logos/' + filename):
-        if os.path.getsize('./logos/' + filename) > 95:
-            return filename
-        else:
-            os.remove('./logos/' + filename)
 
-    if logo_url and logo_url.startswith("http"):
+def load_placeholder_font():
+    global placeholder_font
+    if placeholder_font is None:
         try:
-            response = requests.get(logo_url, timeout=10)
-            if response.status_code == 200:
-                with open('./logos/' + filename, 'wb') as f:
-                    f.write(response.content)
-                if os.path.getsize('./logos/' + filename) > 95:
-                    return filename
-                else:
-                    os.remove('./logos/' + filename)
-        except Exception as e:
-            print(f"Error downloading logo from {logo_url}: {e}")
-            print(f"Generating custom file {filename} instead.")
+            placeholder_font = ImageFont.truetype(
+                "arial.ttf", PLACEHOLDER_FONT_SIZE
+            )
+        except Exception:
+            placeholder_font = ImageFont.load_default()
+    return placeholder_font
+
+
+@lru_cache(maxsize=16384)
+def measure_text(text):
+    return load_placeholder_font().getbbox(text)
+
+
+def generate_channel_logo(text):
+    filename = f"custom_{text_to_filename(text)}"
 
-    # Reached that point, we're creating a custom image
-    if os.path.exists('./logos/custom_' + filename):
-        return 'custom_' + filename
+    if os.path.exists('./logos/' + filename):
+        return filename
 
     padding = 20
-    font_size = 48
     text_color = (255, 255, 255)
     bg_color = (30, 30, 30)
 
-    try:
-        font = ImageFont.truetype("arial.ttf", font_size)
-    except Exception:
-        font = ImageFont.load_default()
-
-    # Crear imagen con tamaño dinámico
-    dummy = Image.new("RGB", (1, 1))
-    draw_dummy = ImageDraw.Draw(dummy)
-
-    bbox = draw_dummy.textbbox((0, 0), text, font=font)
+    bbox = measure_text(text)
     text_width = bbox[2] - bbox[0]
     text_height = bbox[3] - bbox[1]
 
@@ -282,17 +652,58 @@ def generate_channel_logo(text, logo_url):
     text_x = (width - text_width) // 2
     text_y = (height - text_height) // 2
 
-    draw.text((text_x, text_y), text, font=font, fill=text_color)
+    draw.text(
+        (text_x, text_y), text, font=load_placeholder_font(), fill=text_color
+    )
 
-    filename = f"custom_{filename}"
-    img.save('./logos/' + filename, "PNG")
+    img.save(f"./logos/{filename}.{os.getpid()}.tmp", "PNG")
+    os.replace(f"./logos/{filename}.{os.getpid()}.tmp", './logos/' + filename)
     return filename
 
 
+def generate_channel_logos(names, workers=None):
+    """
+    Render the placeholder logo of every distinct name in a process pool,
+    returns {name: filename}.
+    """
+    names = sorted(set(names))
+    if len(names) < 2 or workers == 1:
+        return {name: generate_channel_logo(name) for name in names}
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=load_placeholder_font
+    ) as executor:
+        return dict(zip(
+            names, executor.map(generate_channel_logo, names, chunksize=32)
+        ))
+
+
+def file_digest(path):
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_build_state(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"ids": {}, "stages": {}}
+
+
+def save_build_state(path, state):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{path}.tmp", path)
+
+
 if __name__ == "__main__":
 
     if len(sys.argv) < 2:
-        print("Usage: python create_data.py config.json [step_from=0] [step_to=3]")  # noqa
+        print("Usage: python create_data.py config.json [step_from=0] [step_to=5]")  # noqa
         sys.exit(1)
 
     config_file = sys.argv[1]
@@ -300,51 +711,115 @@ if __name__ == "__main__":
         CONFIG = json.load(f)
 
     json_data_file = CONFIG.get('json_data_file', 'final_data.json')
+    # step files are packed too when the final data file is
+    ext = datafile.PACKED_EXT if datafile.is_packed(json_data_file) \
+        else ".json"
+    upstream_file = f"0_upstream_data{ext}"
+    filtered_file = f"1_filtered_data{ext}"
+    processed_file = f"2_processed_data{ext}"
     step_from = int(sys.argv[2]) if len(sys.argv) > 2 else 0
-    step_to = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    step_to = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    # Incremental builds keep stream ids stable across runs and skip stages
+    # whose inputs (upstream data and config) and output file are unchanged
+    incremental = CONFIG.get("incremental", False)
+    build_state_file = CONFIG.get("build_state_file", "build_state.json")
+    build_state = load_build_state(build_state_file) if incremental else {
+        "ids": {}, "stages": {}
+    }
+    stage_outputs = {
+        1: filtered_file,
+        2: processed_file,
+        3: json_data_file,
+        4: json_data_file,
+    }
+    config_digest = record_digest(CONFIG)
+    stages_run = []
+
+    def stage_key(stage):
+        return hashlib.sha1(
+            f"{upstream_digest}|{config_digest}|{stage}".encode("utf-8")
+        ).hexdigest()
+
+    def run_stage(stage):
+        if not (step_from <= stage and step_to >= stage):
+            return False
+        recorded = build_state["stages"].get(str(stage), {})
+        if incremental and recorded.get("key") == stage_key(stage) and \
+                recorded.get("output") == file_digest(stage_outputs[stage]):
+            print(f"Step {stage} inputs unchanged, skipping it.")
+            return False
+        stages_run.append(stage)
+        return True
 
     if step_from <= 0 and step_to >= 0:
-        upstream_data = {}
-        for ep_name, ep_info in CONFIG['endpoints'].items():
-            if not ep_info.get("enabled", True):
-                print(f"Skipping disabled endpoint: {ep_name}")
-                continue
-            print(f"Processing endpoint: {ep_name}")
-            # raw info from upstream endpoint
-            upstream_data[ep_name] = fetch_from_endpoint(ep_info)
-        with open("0_upstream_data.json", "w") as f:
-            json.dump(upstream_data, f, indent=4)
+        # raw info from upstream endpoints
+        upstream_data = fetch_all(
+            CONFIG['endpoints'], workers=CONFIG.get("fetch_workers", 6)
+        )
+        datafile.dump(upstream_data, upstream_file)
     else:
-        with open("0_upstream_data.json", "r") as f:
-            upstream_data = json.load(f)
+        upstream_data = datafile.load(upstream_file)
+    upstream_digest = file_digest(upstream_file)
 
     # filtered data after applying whitelists/blacklists
-    if step_from <= 1 and step_to >= 1:
+    if run_stage(1):
         filtered_data = filter_data(
             upstream_data,
             whitelisted_grups=CONFIG.get("whitelisted_grups", []),
             custom_live_cats=CONFIG.get("custom_live_categories", {})
         )
-        with open("1_filtered_data.json", "w") as f:
-            json.dump(filtered_data, f, indent=4)
+        datafile.dump(filtered_data, filtered_file)
     else:
-        with open("1_filtered_data.json", "r") as f:
-            filtered_data = json.load(f)
+        filtered_data = datafile.load(filtered_file)
 
     # processed data with direct source URLs and reordered categories
-    if step_from <= 2 and step_to >= 2:
+    if run_stage(2):
         processed_data = process_data(
             filtered_data, CONFIG['endpoints'],
-            CONFIG.get("custom_live_categories", {})
+            CONFIG.get("custom_live_categories", {}),
+            id_map=build_state["ids"] if incremental else None
         )
-        with open("2_processed_data.json", "w") as f:
-            json.dump(processed_data, f, indent=4)
+        datafile.dump(processed_data, processed_file)
     else:
-        with open("2_processed_data.json", "r") as f:
-            processed_data = json.load(f)
+        processed_data = datafile.load(processed_file)
 
-    if step_from <= 3 and step_to >= 3:
+    final_data = None
+    if run_stage(3):
         # Download icons and create missing ones
-        final_data = retrieve_logos(processed_data, CONFIG['base_url'])
-        with open(json_data_file, "w") as f:
-            json.dump(final_data, f, indent=4)
+        final_data = retrieve_logos(
+            processed_data, CONFIG['base_url'], CONFIG.get("logos", {})
+        )
+        if CONFIG.get("logos", {}).get("normalize", True):
+            final_data = normalize_channel_logos(
+                final_data, CONFIG['base_url'], CONFIG.get("logos", {})
+            )
+        datafile.dump(final_data, json_data_file)
+
+    if run_stage(4):
+        if final_data is None:
+            final_data = datafile.load(json_data_file)
+        # Probe movie codecs so the server knows which ones to transcode
+        probe_config = CONFIG.get("probe", {})
+        final_data = probe_vods(
+            final_data,
+            cache_file=probe_config.get("cache_file", "probe_cache.json"),
+            workers=probe_config.get("workers", 8),
+            timeout=probe_config.get("timeout", 10)
+        )
+        datafile.dump(final_data, json_data_file)
+
+    # the guide changes upstream on its own, it's always refreshed
+    if step_from <= 5 and step_to >= 5:
+        if final_data is None:
+            final_data = datafile.load(json_data_file)
+        build_epg(final_data, CONFIG['endpoints'], CONFIG.get("epg", {}))
+
+    if incremental:
+        # outputs are recorded once all stages ran, steps 3 and 4 share one
+        for stage in stages_run:
+            build_state["stages"][str(stage)] = {
+                "key": stage_key(stage),
+                "output": file_digest(stage_outputs[stage]),
+            }
+        save_build_state(build_state_file, build_state)
@@ -0,0 +1,105 @@
+import os
+import sys
+import mmap
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Stream data files (create_data.py steps and the file served by app.py)
+# are JSON, or packed when their name ends in .pack. Packed files hold
+# every top level key as a separate msgpack section behind an index, so
+# readers map the file in memory and only decode the sections they need:
+#   MAGIC | index length (uint32) | index {key: [offset, length]} | sections
+# Convert from one format to the other with:
+#   python3 datafile.py final_data.json final_data.pack
+
+MAGIC = b"XTPK\x01"
+PACKED_EXT = ".pack"
+INDEX_LENGTH = struct.Struct("<I")
+
+
+def is_packed(path):
+    return path.endswith(PACKED_EXT)
+
+
+def check_msgpack():
+    if msgpack is None:
+        raise RuntimeError("msgpack is required for packed data files")
+
+
+def dump(data, path):
+    """
+    Write data to path, packed or as JSON depending on its name. The file
+    is replaced atomically, so readers never see it half written.
+    """
+    tmp_path = f"{path}.tmp"
+    if is_packed(path):
+        check_msgpack()
+        sections = [msgpack.packb(value) for value in data.values()]
+        index, offset = {}, 0
+        for key, section in zip(data, sections):
+            index[key] = [offset, len(section)]
+            offset += len(section)
+        index = msgpack.packb(index)
+        # offsets in the index are relative to the end of the index
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(INDEX_LENGTH.pack(len(index)))
+            f.write(index)
+            for section in sections:
+                f.write(section)
+    else:
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def load(path, keys=None):
+    """
+    Read the data in path. With keys, packed files only decode those
+    sections; JSON files are parsed whole and then filtered.
+    """
+    if not is_packed(path):
+        with open(path) as f:
+            data = json.load(f)
+        if keys is None:
+            return data
+        return {key: data[key] for key in keys if key in data}
+
+    check_msgpack()
+    with open(path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if mapped[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a packed data file")
+        start = len(MAGIC) + INDEX_LENGTH.size
+        (index_length,) = INDEX_LENGTH.unpack_from(mapped, len(MAGIC))
+        view = memoryview(mapped)
+        try:
+            index = msgpack.unpackb(view[start:start + index_length])
+            base = start + index_length
+            data = {}
+            for key, (offset, length) in index.items():
+                if keys is None or key in keys:
+                    data[key] = msgpack.unpackb(
+                        view[base + offset:base + offset + length],
+                        strict_map_key=False
+                    )
+        finally:
+            view.release()
+    return data
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python datafile.py source_file target_file")
+        sys.exit(1)
+    dump(load(sys.argv[1]), sys.argv[2])
+    print(
+        f"Converted {sys.argv[1]} ({os.path.getsize(sys.argv[1])} bytes) to "
+        f"{sys.argv[2]} ({os.path.getsize(sys.argv[2])} bytes)"
+    )
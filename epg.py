@@ -0,0 +1,136 @@
+import os
+import gzip
+import shutil
+import bisect
+import hashlib
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+
+
+# XMLTV guide of the channels in the catalog. create_data.py streams every
+# upstream xmltv.php through filter_xmltv(), keeping only the channels it
+# serves, and writes a gzipped guide the server sends as is, plus an index
+# of programmes per channel for get_short_epg / get_simple_data_table.
+
+XMLTV_HEADER = b'<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n'
+XMLTV_FOOTER = b'</tv>\n'
+EMPTY_XMLTV = XMLTV_HEADER + XMLTV_FOOTER
+
+
+def parse_xmltv_time(value):
+    """
+    Timestamp of an XMLTV date, like 20240131203000 +0100.
+    """
+    value = (value or "").strip()
+    try:
+        if " " in value:
+            return int(datetime.strptime(value, "%Y%m%d%H%M%S %z").timestamp())
+        return int(datetime.strptime(value[:14], "%Y%m%d%H%M%S").replace(
+            tzinfo=timezone.utc).timestamp())
+    except ValueError:
+        return None
+
+
+def filter_xmltv(source, channel_ids):
+    """
+    Parse the XMLTV document in the file-like source incrementally and
+    yield (tag, channel id, element) for the channels and programmes of
+    channel_ids. Elements are dropped once yielded, so memory doesn't grow
+    with the size of the guide.
+    """
+    events = ET.iterparse(source, events=("start", "end"))
+    _, root = next(events)
+    for event, element in events:
+        if event != "end" or element.tag not in ("channel", "programme"):
+            continue
+        channel_id = element.get(
+            "id" if element.tag == "channel" else "channel"
+        )
+        if channel_id in channel_ids:
+            yield element.tag, channel_id, element
+        root.clear()
+
+
+def channels_digest(channel_ids):
+    return hashlib.sha1(
+        "\n".join(sorted(channel_ids)).encode("utf-8")
+    ).hexdigest()
+
+
+def write_fragments(source, channel_ids, prefix, cache_dir, name):
+    """
+    Filter the XMLTV in source to channel_ids, renaming every channel to
+    prefix + id, into gzipped channel and programme fragments in cache_dir.
+    Returns the programme index {channel: [[start, stop, title, desc]]}.
+    """
+    index = {}
+    channels_file = os.path.join(cache_dir, f"{name}.channels.xml.gz")
+    programmes_file = os.path.join(cache_dir, f"{name}.programmes.xml.gz")
+    with gzip.open(f"{channels_file}.tmp", "wb") as channels, \
+            gzip.open(f"{programmes_file}.tmp", "wb") as programmes:
+        for tag, channel_id, element in filter_xmltv(source, channel_ids):
+            new_id = f"{prefix}{channel_id}"
+            if tag == "channel":
+                element.set("id", new_id)
+                channels.write(ET.tostring(element, encoding="utf-8"))
+                continue
+            element.set("channel", new_id)
+            programmes.write(ET.tostring(element, encoding="utf-8"))
+            start = parse_xmltv_time(element.get("start"))
+            stop = parse_xmltv_time(element.get("stop"))
+            if start is None or stop is None:
+                continue
+            index.setdefault(new_id, []).append([
+                start, stop,
+                element.findtext("title") or "",
+                element.findtext("desc") or "",
+            ])
+    os.replace(f"{channels_file}.tmp", channels_file)
+    os.replace(f"{programmes_file}.tmp", programmes_file)
+    for programmes in index.values():
+        programmes.sort()
+    return index
+
+
+def merge_fragments(names, cache_dir, epg_file):
+    """
+    Join the fragments of every endpoint in names into one gzipped XMLTV
+    guide, channels first as the format requires.
+    """
+    with gzip.open(f"{epg_file}.tmp", "wb", compresslevel=9) as out:
+        out.write(XMLTV_HEADER)
+        for kind in ("channels", "programmes"):
+            for name in names:
+                path = os.path.join(cache_dir, f"{name}.{kind}.xml.gz")
+                with gzip.open(path, "rb") as fragment:
+                    shutil.copyfileobj(fragment, out)
+        out.write(XMLTV_FOOTER)
+    os.replace(f"{epg_file}.tmp", epg_file)
+
+
+class ProgrammeIndex:
+    """
+    Programmes per epg_channel_id, sorted by start, as written by
+    write_fragments().
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.stops = {
+            channel: [programme[1] for programme in programmes]
+            for channel, programmes in index.items()
+        }
+
+    def __len__(self):
+        return len(self.index)
+
+    def programmes(self, channel_id):
+        return self.index.get(channel_id, [])
+
+    def upcoming(self, channel_id, now, limit=None):
+        """
+        Programmes of channel_id not over at now: the one on air first.
+        """
+        first = bisect.bisect_right(self.stops.get(channel_id, []), now)
+        programmes = self.index.get(channel_id, [])[first:]
+        return programmes[:limit] if limit else programmes
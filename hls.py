@@ -0,0 +1,407 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from urllib.parse import urlsplit
+
+import m3u8
+import requests
+
+from metrics import UPSTREAM_TTFB_SECONDS, UPSTREAM_ERRORS
+
+
+log = logging.getLogger(__name__)
+
+# rewritten playlists are cached with this in front of every URI, replaced
+# by the path of the requesting user when served
+URI_PREFIX = "\x00hls/"
+
+CONTENT_TYPES = {
+    "m3u8": "application/vnd.apple.mpegurl",
+    "ts": "video/mp2t",
+    "aac": "audio/aac",
+    "m4s": "video/iso.segment",
+    "mp4": "video/mp4",
+    "vtt": "text/vtt",
+}
+
+
+def is_hls(url):
+    return urlsplit(url).path.lower().endswith(".m3u8")
+
+
+def url_token(url):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()[:20]
+
+
+def url_extension(url):
+    ext = os.path.splitext(urlsplit(url).path)[1][1:].lower()
+    return ext if ext.isalnum() and len(ext) <= 5 else "bin"
+
+
+class SegmentCache:
+    """
+    LRU of segment bodies bounded by size, with entries expiring ttl
+    seconds after being fetched. With cache_dir, segments evicted from
+    memory spill to disk, itself an LRU of up to disk_max_bytes.
+    """
+
+    def __init__(self, max_bytes, ttl, cache_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cache_dir = cache_dir if disk_max_bytes else None
+        self.disk_max_bytes = disk_max_bytes
+        # key: (body, expires) in memory, (size, expires) on disk, least
+        # recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.disk_entries = OrderedDict()
+        self.disk_size = 0
+        self._lock = threading.Lock()
+
+        if self.cache_dir:
+            # segments of a previous run are long expired
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for filename in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, filename))
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > time():
+                self.entries.move_to_end(key)
+                return entry[0]
+            disk_entry = self.disk_entries.pop(key, None)
+            if disk_entry:
+                self.disk_size -= disk_entry[0]
+        if not disk_entry:
+            return None
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                body = f.read()
+            os.remove(self._disk_path(key))
+        except OSError:
+            return None
+        if disk_entry[1] <= time():
+            return None
+        self.put(key, body, disk_entry[1])
+        return body
+
+    def put(self, key, body, expires=None):
+        expires = expires or time() + self.ttl
+        with self._lock:
+            previous = self.entries.pop(key, None)
+            if previous:
+                self.size -= len(previous[0])
+            self.entries[key] = (body, expires)
+            self.size += len(body)
+            evicted = []
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old_key, (old_body, old_expires) = \
+                    self.entries.popitem(last=False)
+                self.size -= len(old_body)
+                if old_expires > time():
+                    evicted.append((old_key, old_body, old_expires))
+        if self.cache_dir:
+            for old_key, old_body, old_expires in evicted:
+                self._spill(old_key, old_body, old_expires)
+
+    def _spill(self, key, body, expires):
+        try:
+            with open(self._disk_path(key), "wb") as f:
+                f.write(body)
+        except OSError as e:
+            log.info(f"Error writing segment {key} to disk: {e}")
+            return
+        removed = []
+        with self._lock:
+            self.disk_entries[key] = (len(body), expires)
+            self.disk_size += len(body)
+            while self.disk_size > self.disk_max_bytes and self.disk_entries:
+                old_key, (old_size, _) = self.disk_entries.popitem(last=False)
+                self.disk_size -= old_size
+                removed.append(old_key)
+        for old_key in removed:
+            try:
+                os.remove(self._disk_path(old_key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "segments": len(self.entries),
+                "bytes": self.size,
+                "disk_segments": len(self.disk_entries),
+                "disk_bytes": self.disk_size,
+            }
+
+
+class HlsProxy:
+    """
+    Proxy for HLS channels. Playlists are fetched once per playlist_ttl
+    however many viewers ask for them (single-flight) and rewritten so
+    every variant, key and segment URI points back at the server, under a
+    token mapped to its upstream URL. Segments are fetched once into a
+    SegmentCache shared by all viewers, and the next prefetch segments of
+    the playlist are fetched ahead of the players asking for them.
+    """
+
+    def __init__(self, cache_mb=64, segment_ttl=120, disk_cache_dir=None,
+                 disk_cache_mb=0, playlist_ttl=None, prefetch=2,
+                 prefetch_workers=4, timeout=10, max_urls=20000):
+        self.segments = SegmentCache(
+            cache_mb * 1024 * 1024, segment_ttl,
+            cache_dir=disk_cache_dir,
+            disk_max_bytes=disk_cache_mb * 1024 * 1024,
+        )
+        self.segment_ttl = segment_ttl
+        self.playlist_ttl = playlist_ttl
+        self.prefetch = prefetch
+        self.timeout = timeout
+        self.max_urls = max_urls
+
+        # token: {"url", "playlist": URL of the media playlist listing it}
+        self.urls = OrderedDict()
+        # playlist url: {"text", "expires", "segments": [token, ...]}
+        self.playlists = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._prefetcher = ThreadPoolExecutor(
+            max_workers=prefetch_workers, thread_name_prefix="hls-prefetch"
+        )
+        self._http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=16, pool_maxsize=max(16, prefetch_workers * 2)
+        )
+        self._http.mount("http://", adapter)
+        self._http.mount("https://", adapter)
+
+        self.playlist_requests = 0
+        self.playlist_fetches = 0
+        self.segment_requests = 0
+        self.hits = 0
+        self.joined = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.upstream_bytes = 0
+        self.served_bytes = 0
+        self.saved_bytes = 0
+
+    def _single_flight(self, key, fetch):
+        """
+        Run fetch() for key, or if it's already running for another
+        request, wait for its result instead. Returns (result, joined).
+        """
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = {
+                    "done": threading.Event(), "result": None, "error": None
+                }
+        if not leader:
+            if not call["done"].wait(self.timeout * 2):
+                raise TimeoutError(f"Timed out waiting for {key}")
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"], True
+        try:
+            call["result"] = fetch()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call["done"].set()
+        return call["result"], False
+
+    def _register(self, url, playlist=None):
+        token = url_token(url)
+        with self._lock:
+            self.urls[token] = {"url": url, "playlist": playlist}
+            self.urls.move_to_end(token)
+            while len(self.urls) > self.max_urls:
+                self.urls.popitem(last=False)
+        return token
+
+    def _proxied_uri(self, url, playlist=None):
+        return f"{URI_PREFIX}{self._register(url, playlist)}.{url_extension(url)}"  # noqa
+
+    def _get(self, url, kind):
+        try:
+            response = self._http.get(url, timeout=self.timeout)
+            response.raise_for_status()
+        except Exception:
+            UPSTREAM_ERRORS.inc(kind)
+            raise
+        UPSTREAM_TTFB_SECONDS.observe(response.elapsed.total_seconds(), kind)
+        return response
+
+    def _fetch_playlist(self, url):
+        response = self._get(url, "hls_playlist")
+        # relative URIs are relative to where any redirect ended
+        playlist = m3u8.loads(response.text, uri=response.url)
+        with self._lock:
+            self.playlist_fetches += 1
+            self.upstream_bytes += len(response.content)
+
+        tokens = []
+        if playlist.is_variant:
+            for variant in playlist.playlists:
+                variant.uri = self._proxied_uri(variant.absolute_uri)
+            for media in playlist.media:
+                if media.uri:
+                    media.uri = self._proxied_uri(media.absolute_uri)
+        for key in playlist.keys:
+            if key and key.uri:
+                key.uri = self._proxied_uri(key.absolute_uri)
+        for segment in playlist.segments:
+            init_section = segment.init_section
+            if init_section and init_section.uri:
+                init_section.uri = self._proxied_uri(
+                    init_section.absolute_uri
+                )
+            segment.uri = self._proxied_uri(
+                segment.absolute_uri, url
+            )
+            tokens.append(segment.uri[len(URI_PREFIX):].split(".")[0])
+
+        # live playlists change every segment, refresh them twice as often
+        ttl = self.playlist_ttl
+        if ttl is None:
+            ttl = 30 if playlist.is_variant or playlist.is_endlist else \
+                max(1, (playlist.target_duration or 2) / 2)
+        entry = {
+            "text": playlist.dumps(),
+            "expires": time() + ttl,
+            "segments": tokens,
+        }
+        with self._lock:
+            self.playlists[url] = entry
+        return entry
+
+    def playlist(self, url, base_path):
+        """
+        The playlist at url with its URIs under base_path.
+        """
+        with self._lock:
+            self.playlist_requests += 1
+            entry = self.playlists.get(url)
+        if not entry or entry["expires"] <= time():
+            entry, _ = self._single_flight(
+                url, lambda: self._fetch_playlist(url)
+            )
+        return entry["text"].replace(URI_PREFIX, f"{base_path}/")
+
+    def playlist_url(self, token):
+        with self._lock:
+            entry = self.urls.get(token)
+        return entry["url"] if entry else None
+
+    def _fetch_segment(self, token, url):
+        """
+        Returns (body, fetched): a prefetch may have cached it meanwhile.
+        """
+        body = self.segments.get(token)
+        if body is not None:
+            return body, False
+        response = self._get(url, "hls_segment")
+        body = response.content
+        self.segments.put(token, body)
+        with self._lock:
+            self.upstream_bytes += len(body)
+        return body, True
+
+    def segment(self, token):
+        """
+        The body of the segment (or key) token, from the cache or fetched
+        once for every viewer asking for it. None for unknown tokens.
+        """
+        with self._lock:
+            entry = self.urls.get(token)
+            self.segment_requests += 1
+        if entry is None:
+            return None
+
+        body = self.segments.get(token)
+        if body is not None:
+            counter = "hits"
+        else:
+            (body, fetched), joined = self._single_flight(
+                token, lambda: self._fetch_segment(token, entry["url"])
+            )
+            counter = "joined" if joined else \
+                "misses" if fetched else "hits"
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.served_bytes += len(body)
+            if counter != "misses":
+                self.saved_bytes += len(body)
+            requests_count = self.segment_requests
+        if entry["playlist"]:
+            self._prefetch_after(token, entry["playlist"])
+        if requests_count % 200 == 0:
+            stats = self.stats()
+            log.info(f"HLS segments: {stats['hit_ratio']:.0%} hit ratio, {stats['saved_bytes'] / 1024 / 1024:.1f} MB saved upstream")  # noqa
+        return body
+
+    def _prefetch_after(self, token, playlist_url):
+        if not self.prefetch:
+            return
+        with self._lock:
+            playlist = self.playlists.get(playlist_url)
+            if not playlist or token not in playlist["segments"]:
+                return
+            index = playlist["segments"].index(token)
+            upcoming = [
+                (next_token, self.urls[next_token]["url"])
+                for next_token in
+                playlist["segments"][index + 1:index + 1 + self.prefetch]
+                if next_token in self.urls and
+                next_token not in self._inflight
+            ]
+        for next_token, url in upcoming:
+            if self.segments.get(next_token) is None:
+                self._prefetcher.submit(self._prefetch, next_token, url)
+
+    def _prefetch(self, token, url):
+        try:
+            (_, fetched), joined = self._single_flight(
+                token, lambda: self._fetch_segment(token, url)
+            )
+        except Exception as e:
+            log.info(f"Error prefetching segment {url}: {e}")
+            return
+        if fetched and not joined:
+            with self._lock:
+                self.prefetched += 1
+
+    def content_type(self, extension):
+        return CONTENT_TYPES.get(extension, "application/octet-stream")
+
+    def stats(self):
+        with self._lock:
+            served = self.hits + self.joined + self.misses
+            stats = {
+                "playlist_requests": self.playlist_requests,
+                "playlist_fetches": self.playlist_fetches,
+                "segment_requests": self.segment_requests,
+                "hits": self.hits,
+                "joined": self.joined,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.joined) / served if served else 0.0,  # noqa
+                "prefetched": self.prefetched,
+                "upstream_bytes": self.upstream_bytes,
+                "served_bytes": self.served_bytes,
+                "saved_bytes": self.saved_bytes,
+            }
+        stats.update(self.segments.stats())
+        return stats
@@ -0,0 +1,271 @@
+import io
+import os
+import json
+import re
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from time import time
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+LOGOS_DIR = "./logos"
+# smaller files are error pages or empty images
+MIN_LOGO_SIZE = 95
+# normalized logos are named after a sha1 of their content, downloaded ones
+# after an md5 of their url
+NORMALIZED_LOGO = re.compile(r"^[a-f0-9]{40}\.(webp|png)$")
+
+
+def url_to_filename(url):
+    return hashlib.md5(url.encode('utf-8')).hexdigest() + ".png"
+
+
+class LogoFetcher:
+    """
+    Downloads channel logos concurrently, once per source URL. ETag and
+    Last-Modified of every download are kept in a manifest, so reruns only
+    revalidate logos older than max_age with conditional requests. Requests
+    to a single host are limited to per_host at a time.
+    """
+
+    def __init__(self, logos_dir=LOGOS_DIR, manifest_file=None, workers=16,
+                 per_host=4, max_age=24*3600, timeout=10):
+        self.logos_dir = logos_dir
+        self.manifest_file = manifest_file or \
+            os.path.join(logos_dir, "manifest.json")
+        self.workers = workers
+        self.per_host = per_host
+        self.max_age = max_age
+        self.timeout = timeout
+        self.stats = {
+            "downloaded": 0, "not_modified": 0, "fresh": 0, "failed": 0
+        }
+
+        self.manifest = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+
+        retry = Retry(total=2, backoff_factor=0.5,
+                      status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(
+            max_retries=retry, pool_connections=workers, pool_maxsize=workers
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    def _host_slot(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.Semaphore(self.per_host)
+            return self._host_slots[host]
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def fetch(self, url):
+        """
+        Return the logo filename for url, or None if it can't be retrieved.
+        """
+        filename = url_to_filename(url)
+        path = os.path.join(self.logos_dir, filename)
+        entry = self.manifest.get(url, {})
+        have_file = os.path.exists(path) and \
+            os.path.getsize(path) > MIN_LOGO_SIZE
+
+        if have_file and time() - entry.get("checked", 0) < self.max_age:
+            self._count("fresh")
+            return filename
+
+        headers = {}
+        if have_file and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if have_file and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            with self._host_slot(url):
+                response = self.session.get(
+                    url, headers=headers, timeout=self.timeout
+                )
+        except Exception as e:
+            print(f"Error downloading logo from {url}: {e}")
+            self._count("failed")
+            return filename if have_file else None
+
+        if response.status_code == 304 and have_file:
+            entry["checked"] = int(time())
+            self._count("not_modified")
+        elif response.status_code == 200 and \
+                len(response.content) > MIN_LOGO_SIZE:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(response.content)
+            os.replace(tmp_path, path)
+            entry = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "checked": int(time()),
+            }
+            self._count("downloaded")
+        else:
+            self._count("failed")
+            return filename if have_file else None
+
+        with self._lock:
+            self.manifest[url] = entry
+        return filename
+
+    def fetch_all(self, urls):
+        """
+        Fetch every distinct URL, returns {url: filename or None}.
+        """
+        os.makedirs(self.logos_dir, exist_ok=True)
+        urls = sorted(set(urls))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = dict(zip(urls, executor.map(self.fetch, urls)))
+        self.save_manifest()
+        return results
+
+    def save_manifest(self):
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_file, self.manifest_file)
+
+
+def normalize_logo(path, logos_dir=LOGOS_DIR, max_size=256, format="webp"):
+    """
+    Downscale the logo at path to fit in max_size x max_size and re-encode
+    it as WebP or optimized PNG, named after its content. Returns the new
+    filename, or None if the image can't be decoded.
+    """
+    try:
+        with Image.open(path) as image:
+            image.load()
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA")
+            output = io.BytesIO()
+            if format == "webp":
+                image.save(output, "WEBP", quality=85, method=6)
+            else:
+                image.save(output, "PNG", optimize=True)
+    except Exception as e:
+        print(f"Error normalizing logo {path}: {e}")
+        return None
+
+    body = output.getvalue()
+    filename = f"{hashlib.sha1(body).hexdigest()}.{format}"
+    target = os.path.join(logos_dir, filename)
+    if not os.path.exists(target):
+        with open(f"{target}.tmp", "wb") as f:
+            f.write(body)
+        os.replace(f"{target}.tmp", target)
+    return filename
+
+
+def normalize_logos(filenames, logos_dir=LOGOS_DIR, max_size=256,
+                    format="webp", workers=4):
+    """
+    Normalize every distinct logo file, returns {filename: new filename}
+    with the original filename for logos that can't be normalized (or
+    are already normalized).
+    """
+    def _normalize(filename):
+        if NORMALIZED_LOGO.match(filename):
+            return filename
+        path = os.path.join(logos_dir, filename)
+        return normalize_logo(path, logos_dir, max_size, format) or filename
+
+    filenames = sorted(set(filenames))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(filenames, executor.map(_normalize, filenames)))
+
+
+class LogoStore:
+    """
+    LRU of logo files in memory, up to max_bytes, for the logos route.
+    Entries are revalidated against the file mtime, except for normalized
+    logos, whose content never changes under the same name.
+    """
+
+    def __init__(self, logos_dir=LOGOS_DIR, max_bytes=32 * 1024 * 1024):
+        self.logos_dir = logos_dir
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """
+        Return {body, etag, content_type, immutable} for filename, or None
+        if there is no such logo.
+        """
+        path = os.path.join(self.logos_dir, filename)
+        immutable = bool(NORMALIZED_LOGO.match(filename))
+        mtime = None
+        if not immutable:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                return None
+
+        with self._lock:
+            entry = self.entries.get(filename)
+            if entry and (immutable or entry["mtime"] == mtime):
+                self.entries.move_to_end(filename)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        try:
+            with open(path, "rb") as f:
+                body = f.read()
+        except OSError:
+            return None
+        entry = {
+            "body": body,
+            "etag": filename.split(".")[0] if immutable
+            else hashlib.md5(body).hexdigest(),
+            "content_type": mimetypes.guess_type(filename)[0]
+            or "application/octet-stream",
+            "immutable": immutable,
+            "mtime": mtime,
+        }
+        if len(body) > self.max_bytes:
+            return entry
+
+        with self._lock:
+            previous = self.entries.pop(filename, None)
+            if previous:
+                self.size -= len(previous["body"])
+            self.entries[filename] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted["body"])
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self.entries), "bytes": self.size,
+                "hits": self.hits, "misses": self.misses,
+            }
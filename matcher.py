@@ -0,0 +1,155 @@
+# Name matchers compiled once from config.json rules, so filtering and
+# processing streams is a single pass over them instead of testing every
+# stream against every rule. Matching is case insensitive, as the rules
+# have always been.
+
+
+class PrefixTrie:
+    """
+    Lowercased prefix trie. Each prefix carries a payload, matches() returns
+    the payloads of every prefix of the text.
+    """
+
+    def __init__(self, prefixes=()):
+        # node: {char: child node}, payloads of a prefix ending there
+        # stored under the "" key
+        self.root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix, payload=None):
+        node = self.root
+        for char in prefix.lower():
+            node = node.setdefault(char, {})
+        node.setdefault("", set()).add(payload)
+
+    def __bool__(self):
+        return bool(self.root)
+
+    def match(self, text):
+        node = self.root
+        if "" in node:
+            return True
+        for char in text.lower():
+            node = node.get(char)
+            if node is None:
+                return False
+            if "" in node:
+                return True
+        return False
+
+    def matches(self, text):
+        found = set(self.root.get("", ()))
+        node = self.root
+        for char in text.lower():
+            node = node.get(char)
+            if node is None:
+                break
+            found.update(node.get("", ()))
+        return found
+
+
+class SubstringAutomaton:
+    """
+    Lowercased Aho-Corasick automaton: finds every pattern contained in a
+    text in one pass over it. Patterns carry a payload like in PrefixTrie.
+    """
+
+    def __init__(self, patterns=()):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [set()]
+        self.built = True
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern, payload=None):
+        state = 0
+        for char in pattern.lower():
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(set())
+                self.goto[state][char] = next_state
+            state = next_state
+        self.out[state].add(payload)
+        self.built = False
+
+    def build(self):
+        # breadth first, so fail links of shorter states are ready first
+        queue = list(self.goto[0].values())
+        for state in queue:
+            self.fail[state] = 0
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.out[next_state] |= self.out[self.fail[next_state]]
+        self.built = True
+
+    def __bool__(self):
+        return len(self.goto) > 1 or bool(self.out[0])
+
+    def _scan(self, text, first_only):
+        if not self.built:
+            self.build()
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set(out[0])
+        if found and first_only:
+            return found
+        state = 0
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+                if first_only:
+                    break
+        return found
+
+    def match(self, text):
+        return bool(self._scan(text, first_only=True))
+
+    def matches(self, text):
+        return self._scan(text, first_only=False)
+
+
+class ChannelRules:
+    """
+    channel_startswith / channel_has rules of every custom live category.
+    """
+
+    def __init__(self, custom_live_cats):
+        self.categories = list(custom_live_cats)
+        self.prefixes = PrefixTrie()
+        self.substrings = SubstringAutomaton()
+        for index, category in enumerate(self.categories):
+            rules = custom_live_cats[category]
+            for prefix in rules.get("channel_startswith", []):
+                self.prefixes.add(prefix, index)
+            for pattern in rules.get("channel_has", []):
+                self.substrings.add(pattern, index)
+        self.substrings.build()
+
+    def match(self, name):
+        """
+        Whether name belongs to any custom category.
+        """
+        return (
+            bool(self.prefixes) and self.prefixes.match(name)
+        ) or (
+            bool(self.substrings) and self.substrings.match(name)
+        )
+
+    def matching_categories(self, name):
+        """
+        Custom categories name belongs to, in config order.
+        """
+        indexes = self.prefixes.matches(name) | self.substrings.matches(name)
+        return [self.categories[index] for index in sorted(indexes)]
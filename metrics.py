@@ -0,0 +1,175 @@
+import bisect
+import threading
+
+
+# Prometheus metrics in the text exposition format, without the client
+# library. Request paths observe histograms and bump counters directly;
+# streaming loops keep plain counters of their own (bytes per relay, per
+# transcode, ...) that are only read when /metrics is scraped, so nothing
+# is done per chunk.
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+DURATION_BUCKETS = (1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 14400)
+
+
+def format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = ",".join(
+        f'{name}="{escape(value)}"' for name, value in zip(labelnames, values)
+    )
+    return f"{{{pairs}}}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def format_value(value):
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"
+        ]
+        with self._lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append(
+                f"{self.name}{format_labels(self.labelnames, labels)} "
+                f"{format_value(value)}"
+            )
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels: [count per bucket (+Inf last), sum]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0
+                ]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            values = sorted(
+                (labels, (list(counts), total))
+                for labels, (counts, total) in self.values.items()
+            )
+        for labels, (counts, total) in values:
+            labelnames = self.labelnames + ("le",)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket"
+                    f"{format_labels(labelnames, labels + (bound,))} "
+                    f"{cumulative}"
+                )
+            suffix = format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{suffix} {format_value(total)}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+def render_samples(name, help, type, samples, labelnames=()):
+    """
+    Lines of a metric read at scrape time, samples being (labels, value).
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    for labels, value in samples:
+        lines.append(
+            f"{name}{format_labels(labelnames, labels)} {format_value(value)}"
+        )
+    return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "xtreamer_request_seconds",
+    "Time to the response headers, per route.",
+    ("route",),
+)
+PLAYER_API_SECONDS = Histogram(
+    "xtreamer_player_api_seconds",
+    "Time to the response headers of player_api.php, per action.",
+    ("action",),
+)
+UPSTREAM_TTFB_SECONDS = Histogram(
+    "xtreamer_upstream_ttfb_seconds",
+    "Time to the first byte of upstream responses, per kind of request.",
+    ("kind",),
+)
+UPSTREAM_ERRORS = Counter(
+    "xtreamer_upstream_errors_total",
+    "Failed upstream requests, per kind of request.",
+    ("kind",),
+)
+FFPROBE_SECONDS = Histogram(
+    "xtreamer_ffprobe_seconds",
+    "Duration of ffprobe runs.",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+FFMPEG_SECONDS = Histogram(
+    "xtreamer_ffmpeg_seconds",
+    "Lifetime of ffmpeg transcodes.",
+    buckets=DURATION_BUCKETS,
+)
+
+REGISTRY = (
+    REQUEST_SECONDS,
+    PLAYER_API_SECONDS,
+    UPSTREAM_TTFB_SECONDS,
+    UPSTREAM_ERRORS,
+    FFPROBE_SECONDS,
+    FFMPEG_SECONDS,
+)
+
+
+def render(collectors=()):
+    """
+    The exposition text of every registered metric, followed by the lines
+    returned by each of collectors().
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    for collect in collectors:
+        lines += collect()
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,165 @@
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+from time import time
+
+
+log = logging.getLogger(__name__)
+
+
+class PresignedUrls:
+    """
+    Presigned URLs for S3 keys, generated with generate(key, expires_in).
+    URLs are kept in a bounded LRU and handed out while they have more than
+    refresh_before seconds left; a background thread renews them before
+    that, and pre-warms the prewarm most requested keys, so requests
+    rarely sign anything themselves. Request counts are kept for at most
+    max_entries keys. Valid URLs and request counts are persisted to
+    cache_file on every refresh that changed them, and on stop().
+    """
+
+    def __init__(self, generate, cache_file=None, max_entries=10000,
+                 expires_in=6*3600, refresh_before=3600, refresh_interval=300,
+                 prewarm=0):
+        self.generate = generate
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.expires_in = expires_in
+        self.refresh_before = refresh_before
+        self.refresh_interval = refresh_interval
+        self.prewarm = prewarm
+        # key: {"url", "expires"}, least recently used first
+        self.entries = OrderedDict()
+        self.requests = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshed = 0
+        # URLs signed since the last save
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._stop = threading.Event()
+
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    saved = json.load(f)
+                now = time()
+                for key, entry in saved.get("entries", {}).items():
+                    if entry["expires"] - now > refresh_before:
+                        self.entries[key] = entry
+                self.requests = saved.get("requests", {})
+            except Exception as e:
+                log.info(f"Ignoring unreadable presigned URLs {cache_file}: {e}")  # noqa
+
+    def _sign(self, key):
+        entry = {
+            "url": self.generate(key, self.expires_in),
+            "expires": int(time()) + self.expires_in,
+        }
+        with self._lock:
+            self.entries[key] = entry
+            self._dirty = True
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def get(self, key):
+        """
+        A presigned URL for key, valid for at least refresh_before seconds.
+        """
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            entry = self.entries.get(key)
+            if entry and entry["expires"] - time() > self.refresh_before:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["url"]
+            self.misses += 1
+        return self._sign(key)["url"]
+
+    def refresh(self):
+        """
+        Renew URLs that would go stale before the next refresh, and sign
+        the most requested keys that aren't cached.
+        """
+        deadline = time() + self.refresh_before + 2 * self.refresh_interval
+        with self._lock:
+            keys = [
+                key for key, entry in self.entries.items()
+                if entry["expires"] < deadline
+            ]
+            if self.prewarm:
+                popular = sorted(
+                    self.requests, key=self.requests.get, reverse=True
+                )[:self.prewarm]
+                keys += [key for key in popular if key not in self.entries]
+            self._prune_requests()
+
+        for key in keys:
+            try:
+                self._sign(key)
+            except Exception as e:
+                log.info(f"Error presigning {key}: {e}")
+                continue
+            with self._lock:
+                self.refreshed += 1
+        if self._dirty:
+            self.save()
+
+    def _prune_requests(self):
+        # keep the most requested keys, halving their counts so keys
+        # popular lately can catch up with the ones popular long ago
+        if len(self.requests) <= self.max_entries:
+            return
+        popular = sorted(
+            self.requests, key=self.requests.get, reverse=True
+        )[:self.max_entries // 2]
+        self.requests = {
+            key: (self.requests[key] + 1) // 2 for key in popular
+        }
+
+    def save(self):
+        if not self.cache_file:
+            return
+        with self._save_lock:
+            with self._lock:
+                saved = {
+                    "entries": dict(self.entries),
+                    "requests": dict(self.requests),
+                }
+                self._dirty = False
+            tmp_file = f"{self.cache_file}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(saved, f)
+            os.replace(tmp_file, self.cache_file)
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                log.info(f"Error refreshing presigned URLs: {e}")
+            if self._stop.wait(self.refresh_interval):
+                return
+
+    def start(self):
+        threading.Thread(
+            target=self.run, name="presigned-urls", daemon=True
+        ).start()
+
+    def stop(self):
+        self._stop.set()
+        self.save()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshed": self.refreshed,
+            }
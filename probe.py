@@ -0,0 +1,151 @@
+import os
+import json
+import threading
+import subprocess
+import logging
+from time import time, perf_counter
+
+from metrics import FFPROBE_SECONDS
+
+
+log = logging.getLogger(__name__)
+
+
+def probe_media(url, timeout=5):
+    """
+    Run ffprobe against url and return its audio/video codecs and container,
+    or None if it can't be probed.
+    """
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-show_entries", "stream=codec_type,codec_name:format=format_name",
+        "-of", "json",
+        url
+    ]
+
+    started = perf_counter()
+    try:
+        out = subprocess.check_output(
+            cmd, timeout=timeout, stderr=subprocess.DEVNULL
+        )
+        data = json.loads(out)
+    except Exception:
+        return None
+    finally:
+        FFPROBE_SECONDS.observe(perf_counter() - started)
+
+    result = {"audio_codec": None, "video_codec": None, "container": None}
+    for stream in data.get("streams", []):
+        field = f"{stream.get('codec_type')}_codec"
+        if field in result and result[field] is None:
+            result[field] = stream.get("codec_name")
+    result["container"] = data.get("format", {}).get("format_name")
+    return result
+
+
+class ProbeCache:
+    """
+    Probe results persisted to a JSON file and keyed by something stable
+    for the media (its URL, or the S3 key for uploaded movies). Failed
+    probes are remembered for a shorter time so a dead URL doesn't stall
+    every request, and concurrent probes for the same key share one
+    ffprobe run. New results are written at most every save_interval
+    seconds, in the background, since the file holds the whole catalog.
+    """
+
+    def __init__(self, cache_file="probe_cache.json", ttl=7*24*3600,
+                 fail_ttl=600, save_interval=30):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.fail_ttl = fail_ttl
+        self.save_interval = save_interval
+        self.entries = {}
+        self.inflight = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                log.info(f"Ignoring unreadable probe cache {cache_file}: {e}")
+
+    def get(self, key):
+        """
+        Return (found, result) for a cached, non expired, entry.
+        """
+        entry = self.entries.get(key)
+        if not entry:
+            return False, None
+        ttl = self.ttl if entry["result"] else self.fail_ttl
+        if time() - entry["probed"] > ttl:
+            return False, None
+        return True, entry["result"]
+
+    def set(self, key, result, save=True):
+        with self._lock:
+            self.entries[key] = {"result": result, "probed": int(time())}
+        if save and self.save_interval:
+            self.save_later()
+        elif save:
+            self.save()
+
+    def save_later(self):
+        """
+        Save within save_interval seconds, along with whatever else gets
+        probed meanwhile.
+        """
+        with self._lock:
+            if self._save_timer is not None or not self.cache_file:
+                return
+            self._save_timer = threading.Timer(
+                self.save_interval, self._scheduled_save
+            )
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _scheduled_save(self):
+        with self._lock:
+            self._save_timer = None
+        try:
+            self.save()
+        except Exception as e:
+            log.info(f"Error saving probe cache {self.cache_file}: {e}")
+
+    def save(self):
+        if not self.cache_file:
+            return
+        with self._save_lock:
+            with self._lock:
+                entries = dict(self.entries)
+            tmp_file = f"{self.cache_file}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_file, self.cache_file)
+
+    def probe(self, key, url, timeout=5, save=True):
+        found, result = self.get(key)
+        if found:
+            return result
+
+        with self._lock:
+            event = self.inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self.inflight[key] = threading.Event()
+
+        if not leader:
+            event.wait(timeout + 1)
+            return self.get(key)[1]
+
+        try:
+            result = probe_media(url, timeout=timeout)
+            self.set(key, result, save=save)
+            return result
+        finally:
+            with self._lock:
+                del self.inflight[key]
+            event.set()
@@ -0,0 +1,374 @@
+import asyncio
+import threading
+import logging
+import requests
+from collections import deque
+from time import time, perf_counter
+
+from metrics import UPSTREAM_TTFB_SECONDS, UPSTREAM_ERRORS
+
+
+log = logging.getLogger(__name__)
+
+
+class ChannelRelay:
+    """
+    One upstream connection for a live channel, shared by every client
+    watching it. The reader thread fills a bounded ring buffer of chunks and
+    each client generator reads from it at its own offset.
+    """
+
+    def __init__(self, key, url, buffer_chunks=32, join_chunks=4,
+                 chunk_size=256*1024, idle_grace=10, on_close=None,
+                 channel=None):
+        self.key = key
+        self.url = url
+        # label for metrics, the url has the upstream credentials
+        self.channel = channel or "unknown"
+        self.buffer_chunks = buffer_chunks
+        self.join_chunks = join_chunks
+        self.chunk_size = chunk_size
+        self.idle_grace = idle_grace
+        self.on_close = on_close
+
+        self.content_type = "video/mp2t"
+        self.clients = 0
+        self.closed = False
+        self.idle_since = time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        # chunks[0] has sequence number first_seq, next_seq is the one that
+        # will be assigned to the next chunk read from upstream
+        self.chunks = deque(maxlen=buffer_chunks)
+        self.first_seq = 0
+        self.next_seq = 0
+
+        self._cond = threading.Condition()
+        self._response = None
+        self._thread = None
+
+    def start(self):
+        self._response = requests.get(self.url, stream=True, timeout=10)
+        UPSTREAM_TTFB_SECONDS.observe(
+            self._response.elapsed.total_seconds(), "relay"
+        )
+        self.content_type = \
+            self._response.headers.get("Content-Type", "video/mp2t")
+        self._thread = threading.Thread(
+            target=self._read, name=f"relay-{self.key}", daemon=True
+        )
+        self._thread.start()
+        log.info(f"Relay started for channel {self.key} from: {self.url}")
+
+    def _read(self):
+        try:
+            for chunk in self._response.iter_content(chunk_size=self.chunk_size):  # noqa
+                if not chunk:
+                    continue
+                with self._cond:
+                    if len(self.chunks) == self.buffer_chunks:
+                        self.first_seq += 1
+                    self.chunks.append(chunk)
+                    self.next_seq += 1
+                    self.bytes_in += len(chunk)
+                    self._cond.notify_all()
+                    if self._idle_expired():
+                        break
+        except Exception as e:
+            log.info(f"Relay for channel {self.key} stopped reading: {e}")
+        finally:
+            self.close()
+
+    def _idle_expired(self):
+        return (
+            self.clients == 0 and
+            time() - self.idle_since > self.idle_grace
+        )
+
+    def close(self):
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify_all()
+        if self._response is not None:
+            self._response.close()
+        log.info(f"Relay closed for channel {self.key}")
+        if self.on_close:
+            self.on_close(self)
+
+    def attach(self):
+        """
+        Register a client and return the sequence number it should start
+        reading from, a few chunks back so playback starts right away.
+        """
+        with self._cond:
+            self.clients += 1
+            log.info(f"Channel {self.key} fan-out: {self.clients} clients")
+            return max(self.first_seq, self.next_seq - self.join_chunks)
+
+    def detach(self):
+        with self._cond:
+            self.clients -= 1
+            if self.clients == 0:
+                self.idle_since = time()
+            log.info(f"Channel {self.key} fan-out: {self.clients} clients")
+
+    def next_chunk(self, seq, timeout=30):
+        """
+        Return (seq, chunk) for the first chunk available at or after seq,
+        or (seq, None) once the relay is closed or stalled. Clients that fall
+        behind the ring buffer skip ahead to the oldest chunk still held.
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: seq < self.next_seq or self.closed, timeout=timeout
+            ):
+                return seq, None
+            if seq >= self.next_seq:
+                return seq, None
+            seq = max(seq, self.first_seq)
+            chunk = self.chunks[seq - self.first_seq]
+            self.bytes_out += len(chunk)
+            return seq, chunk
+
+    def iter_client(self):
+        seq = self.attach()
+        try:
+            while True:
+                seq, chunk = self.next_chunk(seq)
+                if chunk is None:
+                    break
+                seq += 1
+                yield chunk
+        finally:
+            self.detach()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "url": self.url,
+                "channel": self.channel,
+                "clients": self.clients,
+                "buffered_chunks": len(self.chunks),
+                "chunks_read": self.next_seq,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
+
+
+class RelayManager:
+    """
+    Registry of running channel relays, keyed by upstream URL so duplicated
+    channels (custom categories) share the same relay.
+    """
+
+    def __init__(self, **relay_options):
+        self.relay_options = relay_options
+        self.relays = {}
+        # channel: [bytes_in, bytes_out] of relays closed and left by all
+        # their clients, closed relays still being read are in retired
+        self.closed_bytes = {}
+        self.retired = []
+        self._lock = threading.Lock()
+
+    def get(self, url, channel=None):
+        with self._lock:
+            relay = self.relays.get(url)
+            if relay and not relay.closed:
+                return relay
+            relay = ChannelRelay(
+                url, url, on_close=self._remove, channel=channel,
+                **self.relay_options
+            )
+            self.relays[url] = relay
+        try:
+            relay.start()
+        except Exception:
+            UPSTREAM_ERRORS.inc("relay")
+            relay.close()
+            raise
+        return relay
+
+    def _remove(self, relay):
+        with self._lock:
+            if self.relays.get(relay.key) is relay:
+                del self.relays[relay.key]
+            self.retired.append(relay)
+            self._fold_retired()
+
+    def _fold_retired(self):
+        # called with the lock held
+        for relay in [r for r in self.retired if r.clients == 0]:
+            self.retired.remove(relay)
+            totals = self.closed_bytes.setdefault(relay.channel, [0, 0])
+            totals[0] += relay.bytes_in
+            totals[1] += relay.bytes_out
+
+    def bytes_by_channel(self):
+        """
+        {channel: [bytes_in, bytes_out]} relayed since the server started.
+        """
+        with self._lock:
+            self._fold_retired()
+            relays = list(self.relays.values()) + self.retired
+            totals = {
+                channel: list(channel_bytes)
+                for channel, channel_bytes in self.closed_bytes.items()
+            }
+        for relay in relays:
+            channel_bytes = totals.setdefault(relay.channel, [0, 0])
+            channel_bytes[0] += relay.bytes_in
+            channel_bytes[1] += relay.bytes_out
+        return totals
+
+    def stats(self):
+        with self._lock:
+            relays = list(self.relays.values())
+        return {relay.key: relay.stats() for relay in relays}
+
+
+class AsyncChannelRelay:
+    """
+    ChannelRelay for the ASGI server: the upstream reader is a task using a
+    non-blocking HTTP client and clients are async generators.
+    """
+
+    def __init__(self, key, url, client, buffer_chunks=32, join_chunks=4,
+                 chunk_size=256*1024, idle_grace=10, on_close=None,
+                 channel=None):
+        self.key = key
+        self.url = url
+        self.channel = channel or "unknown"
+        self.client = client
+        self.buffer_chunks = buffer_chunks
+        self.join_chunks = join_chunks
+        self.chunk_size = chunk_size
+        self.idle_grace = idle_grace
+        self.on_close = on_close
+
+        self.content_type = "video/mp2t"
+        self.clients = 0
+        self.closed = False
+        self.idle_since = time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        self.chunks = deque(maxlen=buffer_chunks)
+        self.first_seq = 0
+        self.next_seq = 0
+
+        # replaced by a fresh event every time a chunk arrives
+        self._new_chunk = asyncio.Event()
+        self._response = None
+        self._task = None
+
+    async def start(self):
+        request = self.client.build_request("GET", self.url, timeout=10)
+        started = perf_counter()
+        self._response = await self.client.send(request, stream=True)
+        UPSTREAM_TTFB_SECONDS.observe(perf_counter() - started, "relay")
+        self.content_type = \
+            self._response.headers.get("Content-Type", "video/mp2t")
+        self._task = asyncio.create_task(self._read())
+        log.info(f"Relay started for channel {self.key} from: {self.url}")
+
+    async def _read(self):
+        try:
+            async for chunk in self._response.aiter_bytes(self.chunk_size):
+                if not chunk:
+                    continue
+                if len(self.chunks) == self.buffer_chunks:
+                    self.first_seq += 1
+                self.chunks.append(chunk)
+                self.next_seq += 1
+                self.bytes_in += len(chunk)
+                self._notify()
+                if self.clients == 0 and \
+                        time() - self.idle_since > self.idle_grace:
+                    break
+        except Exception as e:
+            log.info(f"Relay for channel {self.key} stopped reading: {e}")
+        finally:
+            await self.close()
+
+    def _notify(self):
+        event, self._new_chunk = self._new_chunk, asyncio.Event()
+        event.set()
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._notify()
+        if self._response is not None:
+            await self._response.aclose()
+        log.info(f"Relay closed for channel {self.key}")
+        if self.on_close:
+            self.on_close(self)
+
+    async def iter_client(self, timeout=30):
+        self.clients += 1
+        log.info(f"Channel {self.key} fan-out: {self.clients} clients")
+        seq = max(self.first_seq, self.next_seq - self.join_chunks)
+        try:
+            while True:
+                if seq < self.next_seq:
+                    seq = max(seq, self.first_seq)
+                    chunk = self.chunks[seq - self.first_seq]
+                    seq += 1
+                    self.bytes_out += len(chunk)
+                    yield chunk
+                    continue
+                if self.closed:
+                    break
+                try:
+                    await asyncio.wait_for(self._new_chunk.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            self.clients -= 1
+            if self.clients == 0:
+                self.idle_since = time()
+            log.info(f"Channel {self.key} fan-out: {self.clients} clients")
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "channel": self.channel,
+            "clients": self.clients,
+            "buffered_chunks": len(self.chunks),
+            "chunks_read": self.next_seq,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+class AsyncRelayManager(RelayManager):
+    """
+    RelayManager for the ASGI server, all relays share one async HTTP
+    client. Everything runs on the event loop so the lock is never
+    contended.
+    """
+
+    def __init__(self, client, **relay_options):
+        super().__init__(**relay_options)
+        self.client = client
+
+    async def get(self, url, channel=None):
+        relay = self.relays.get(url)
+        if relay and not relay.closed:
+            return relay
+        relay = AsyncChannelRelay(
+            url, url, self.client, on_close=self._remove, channel=channel,
+            **self.relay_options
+        )
+        self.relays[url] = relay
+        try:
+            await relay.start()
+        except Exception:
+            UPSTREAM_ERRORS.inc("relay")
+            await relay.close()
+            raise
+        return relay
@@ -0,0 +1,138 @@
+import os
+import hmac
+import hashlib
+import itertools
+import threading
+from time import time, monotonic
+
+
+class CredentialRegistry:
+    """
+    Users from the config credentials, keyed by username with a salted hash
+    of their password, so a login is a dict lookup and a constant time
+    comparison. Users can have their own max_connections.
+    """
+
+    def __init__(self, credentials):
+        self.users = {}
+        for cred in credentials:
+            salt = os.urandom(16)
+            self.users[cred["username"]] = {
+                "salt": salt,
+                "password": self._hash(salt, cred["password"]),
+                "max_connections": cred.get("max_connections"),
+            }
+
+    def _hash(self, salt, password):
+        return hashlib.sha256(salt + str(password).encode("utf-8")).digest()
+
+    def check(self, username, password):
+        user = self.users.get(username)
+        if user is None or password is None:
+            return False
+        return hmac.compare_digest(
+            user["password"], self._hash(user["salt"], password)
+        )
+
+    def max_connections(self, username):
+        user = self.users.get(username)
+        return user["max_connections"] if user else None
+
+
+class StreamLimitReached(Exception):
+    def __init__(self, message, status=503):
+        super().__init__(message)
+        self.status = status
+
+
+class StreamSessions:
+    """
+    Streams being served per user (proxied lives, and movies, transcoded
+    or not), with caps on how many a user and the whole server can hold at
+    once. A stream over a cap waits up to queue_timeout seconds for one to
+    end before being rejected, so it never reaches the upstream or an
+    ffmpeg slot. A cap of 0 is no cap.
+    """
+
+    def __init__(self, max_streams=0, max_streams_per_user=0,
+                 queue_timeout=0, credentials=None):
+        self.max_streams = max_streams
+        self.max_streams_per_user = max_streams_per_user
+        self.queue_timeout = queue_timeout
+        self.credentials = credentials
+        self.sessions = {}
+        self.total = 0
+        self.rejected = 0
+        self._ids = itertools.count(1)
+        self._changed = threading.Condition()
+
+    def user_limit(self, username):
+        limit = None
+        if self.credentials:
+            limit = self.credentials.max_connections(username)
+        return limit if limit is not None else self.max_streams_per_user
+
+    def active(self, username):
+        with self._changed:
+            return len(self.sessions.get(username, {}))
+
+    def _full(self, username):
+        user_limit = self.user_limit(username)
+        if user_limit and len(self.sessions.get(username, {})) >= user_limit:
+            return StreamLimitReached(
+                f"Too many streams for {username} ({user_limit})", 429
+            )
+        if self.max_streams and self.total >= self.max_streams:
+            return StreamLimitReached(
+                f"Too many streams on the server ({self.max_streams})"
+            )
+        return None
+
+    def acquire(self, username, kind, stream_id):
+        """
+        Open a session for a stream of username, waiting for a free slot
+        up to queue_timeout. Raises StreamLimitReached if none frees up.
+        """
+        deadline = monotonic() + self.queue_timeout
+        with self._changed:
+            while True:
+                full = self._full(username)
+                if full is None:
+                    break
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise full
+                self._changed.wait(remaining)
+
+            session = {
+                "id": next(self._ids),
+                "username": username,
+                "kind": kind,
+                "stream_id": stream_id,
+                "started": int(time()),
+            }
+            self.sessions.setdefault(username, {})[session["id"]] = session
+            self.total += 1
+            return session
+
+    def release(self, session):
+        with self._changed:
+            user_sessions = self.sessions.get(session["username"], {})
+            if user_sessions.pop(session["id"], None) is None:
+                return
+            if not user_sessions:
+                del self.sessions[session["username"]]
+            self.total -= 1
+            self._changed.notify_all()
+
+    def stats(self):
+        with self._changed:
+            return {
+                "active": self.total,
+                "rejected": self.rejected,
+                "users": {
+                    username: len(sessions)
+                    for username, sessions in self.sessions.items()
+                },
+            }
@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app as xtreamer  # noqa: E402
+import asgi  # noqa: E402
+
+
+# List actions of the SQLite catalog, without the response cache, are
+# streamed from a cursor that only works on the thread that opened it, so
+# they must be streamed whole from one thread by the ASGI server.
+
+MOVIES = 5000
+
+
+def call(path, query):
+    scope = {
+        "type": "http", "method": "GET", "path": path,
+        "query_string": query.encode("latin-1"), "headers": [],
+        "root_path": "", "scheme": "http", "http_version": "1.1",
+        "server": ("127.0.0.1", 8080), "client": ("127.0.0.1", 50000),
+    }
+    messages = []
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b""}
+        # the client never goes away
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        await asgi.application(scope, receive, send)
+    asyncio.run(run())
+    return messages
+
+
+class SqliteListStreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        data_file = os.path.join(self.tmp.name, "final_data.json")
+        with open(data_file, "w") as f:
+            json.dump({
+                "live_streams": [], "live_categories": [],
+                "movie_categories": [{"category_id": "1"}],
+                "movie_streams": [
+                    {"stream_id": i, "name": f"Movie {i}", "category_id": "1"}
+                    for i in range(1, MOVIES + 1)
+                ],
+            }, f)
+        self.config = xtreamer.CONFIG
+        xtreamer.CONFIG = {
+            "credentials": [{"username": "u", "password": "p"}],
+            "json_data_file": data_file,
+            "catalog_backend": "sqlite",
+            "catalog_db": os.path.join(self.tmp.name, "catalog.db"),
+            "response_cache": False,
+        }
+        xtreamer.load_credentials()
+        xtreamer.load_stream_data()
+
+    def tearDown(self):
+        xtreamer.CONFIG = self.config
+        self.tmp.cleanup()
+
+    def test_streams_whole_list(self):
+        messages = call(
+            "/player_api.php",
+            "username=u&password=p&action=get_vod_streams"
+        )
+        self.assertEqual(messages[0]["type"], "http.response.start")
+        self.assertEqual(messages[0]["status"], 200)
+        self.assertFalse(messages[-1].get("more_body"))
+        body = b"".join(m.get("body", b"") for m in messages[1:])
+        movies = json.loads(body)
+        self.assertEqual(len(movies), MOVIES)
+        self.assertEqual(movies[-1]["stream_id"], MOVIES)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from create_data import process_data  # noqa: E402
+
+
+# process_data on a small two endpoint catalog (category and guide channel
+# remapping, suffixes, custom categories, URLs and ids), compared with the
+# output it's expected to produce. After an intended change of the output,
+# regenerate the golden file and review its diff.
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+
+class ProcessDataTest(unittest.TestCase):
+
+    def test_matches_golden_output(self):
+        fixture = load_fixture("process_data_input.json")
+        result = process_data(
+            fixture["data"], fixture["endpoints_info"],
+            fixture["custom_live_cats"]
+        )
+        self.assertEqual(result, load_fixture("process_data_golden.json"))
+
+
+if __name__ == "__main__":
+    unittest.main()
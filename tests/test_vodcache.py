@@ -0,0 +1,80 @@
+import os
+import sys
+import json
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from vodcache import VodCache  # noqa: E402
+
+
+# Resuming an interrupted fill against an origin that ignores ranges and
+# answers with Origin.status.
+
+MOVIE = bytes(range(256)) * 1000
+FILLED = 98304
+
+
+class Origin(BaseHTTPRequestHandler):
+    status = 200
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = MOVIE if self.status == 200 else b"<html>Unavailable</html>"
+        self.send_response(self.status)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class VodCacheResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/movie.mp4"
+
+        # a fill interrupted by a restart
+        with open(os.path.join(self.tmp.name, "movie.data"), "wb") as f:
+            f.write(MOVIE[:FILLED])
+        with open(os.path.join(self.tmp.name, "index.json"), "w") as f:
+            json.dump({"movie": {
+                "size": len(MOVIE), "filled": FILLED,
+                "content_type": "video/mp4", "last_access": 0,
+            }}, f)
+        # fills are only started by the tests
+        self.cache = VodCache(self.tmp.name, max_gb=1, min_requests=100)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_error_keeps_what_was_filled(self):
+        Origin.status = 503
+        self.cache._fill("movie", self.url)
+        self.assertEqual(self.cache.entries["movie"]["size"], len(MOVIE))
+        self.assertEqual(self.cache.entries["movie"]["filled"], FILLED)
+        self.assertIsNone(self.cache.open("movie", self.url))
+        cached = self.cache.open("movie", self.url, "bytes=0-")
+        self.assertEqual(cached.read(), MOVIE[:FILLED])
+        cached.close()
+
+    def test_range_ignored_starts_over(self):
+        Origin.status = 200
+        self.cache._fill("movie", self.url)
+        self.assertEqual(self.cache.entries["movie"]["filled"], len(MOVIE))
+        cached = self.cache.open("movie", self.url)
+        self.assertEqual(cached.read(), MOVIE)
+        cached.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
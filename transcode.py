@@ -0,0 +1,478 @@
+import os
+import asyncio
+import threading
+import subprocess
+import logging
+from itertools import count
+from time import time, monotonic
+
+from metrics import FFMPEG_SECONDS
+
+
+log = logging.getLogger(__name__)
+
+
+# how often requests waiting for a slot check whether their stream started
+JOIN_POLL = 0.5
+
+
+class TranscodeBusy(Exception):
+    pass
+
+
+def process_cpu_time(pid):
+    """
+    user + system CPU seconds used by pid so far (Linux only, else None).
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return None
+
+
+class TranscodeSession:
+    """
+    One ffmpeg process whose output is shared by every client that joined
+    within the share window. Clients pull: whoever needs a chunk not read
+    yet reads it from ffmpeg, so ffmpeg runs at the pace of the fastest
+    client and chunks are dropped once the slowest one has read them (or
+    the buffer is full, which disconnects clients left behind).
+    """
+
+    def __init__(self, key, cmd, manager, chunk_size=64*1024,
+                 max_buffer_chunks=512, share_window=10):
+        self.key = key
+        self.cmd = cmd
+        self.manager = manager
+        self.chunk_size = chunk_size
+        self.max_buffer_chunks = max_buffer_chunks
+        self.share_window = share_window
+
+        self.started = time()
+        self.chunks = []
+        self.base_seq = 0
+        self.cursors = {}
+        self.eof = False
+        self.reaped = False
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+        self._reading = False
+        self._cond = threading.Condition()
+        self._client_ids = count()
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=10**6
+        )
+
+    @property
+    def joinable(self):
+        # new clients start at byte 0, so only while we still have it
+        return (
+            not self.reaped and
+            self.base_seq == 0 and
+            time() - self.started < self.share_window
+        )
+
+    def attach(self):
+        with self._cond:
+            client_id = next(self._client_ids)
+            self.cursors[client_id] = 0
+            return client_id
+
+    def detach(self, client_id):
+        with self._cond:
+            self.cursors.pop(client_id, None)
+            self._trim()
+            last_client = not self.cursors
+        if last_client:
+            self.manager.close(self)
+
+    def _trim(self):
+        keep_from = min(self.cursors.values(), default=self.base_seq)
+        if self.joinable:
+            keep_from = 0
+        keep_from = max(
+            keep_from,
+            self.base_seq + len(self.chunks) - self.max_buffer_chunks
+        )
+        if keep_from > self.base_seq:
+            del self.chunks[:keep_from - self.base_seq]
+            self.base_seq = keep_from
+
+    def read(self, client_id):
+        """
+        Next chunk for client_id, or None at the end of the output or if
+        the client fell behind the buffer.
+        """
+        while True:
+            with self._cond:
+                seq = self.cursors.get(client_id)
+                if seq is None or seq < self.base_seq:
+                    return None
+                if seq < self.base_seq + len(self.chunks):
+                    self.cursors[client_id] = seq + 1
+                    return self.chunks[seq - self.base_seq]
+                if self.eof:
+                    return None
+                if self._reading:
+                    self._cond.wait()
+                    continue
+                self._reading = True
+
+            try:
+                chunk = self.process.stdout.read1(self.chunk_size)
+            except (ValueError, OSError):
+                # reaped while reading
+                chunk = b""
+
+            with self._cond:
+                self._reading = False
+                if chunk:
+                    self.chunks.append(chunk)
+                    self.bytes_out += len(chunk)
+                    self._trim()
+                else:
+                    self.eof = True
+                self._cond.notify_all()
+            if not chunk:
+                self.manager.reap(self)
+
+    def stats(self):
+        cpu_time = self.cpu_time
+        if not self.reaped:
+            cpu_time = process_cpu_time(self.process.pid) or cpu_time
+        with self._cond:
+            return {
+                "key": self.key,
+                "pid": self.process.pid,
+                "clients": len(self.cursors),
+                "age": round(time() - self.started, 1),
+                "bytes_out": self.bytes_out,
+                "buffered_chunks": len(self.chunks),
+                "cpu_time": cpu_time,
+            }
+
+
+class TranscodeClient:
+    """
+    Response iterable for one client of a session, detaching on close()
+    even if the response was never iterated.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.client_id = session.attach()
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = None if self.closed else self.session.read(self.client_id)
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.session.detach(self.client_id)
+
+
+class TranscodeManager:
+    """
+    Runs at most max_processes ffmpeg at once. Requests over the limit wait
+    up to queue_timeout seconds for a free slot, and requests for a stream
+    that started transcoding less than share_window seconds ago share its
+    output instead of starting another ffmpeg.
+    """
+
+    def __init__(self, max_processes=2, queue_timeout=30, share_window=10,
+                 max_buffer_chunks=512):
+        self.max_processes = max_processes
+        self.queue_timeout = queue_timeout
+        self.share_window = share_window
+        self.max_buffer_chunks = max_buffer_chunks
+
+        self.sessions = {}
+        self.queued = 0
+        self.total_cpu_time = 0.0
+        self.total_bytes_out = 0
+        self.total_transcodes = 0
+        self._slots = threading.BoundedSemaphore(max_processes)
+        self._lock = threading.Lock()
+
+    def _joinable(self, key):
+        session = self.sessions.get(key)
+        if session and session.joinable:
+            log.info(f"Sharing transcode session for {key}")
+            return session
+        return None
+
+    def open(self, key, cmd):
+        deadline = monotonic() + self.queue_timeout
+        with self._lock:
+            session = self._joinable(key)
+            if session:
+                return TranscodeClient(session)
+            self.queued += 1
+
+        # waiting for a slot, the same stream may start meanwhile (another
+        # waiter got a slot first), then it's shared
+        try:
+            while True:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    log.info(f"No transcode slot for {key} after {self.queue_timeout}s")  # noqa
+                    raise TranscodeBusy(key)
+                if self._slots.acquire(timeout=min(remaining, JOIN_POLL)):
+                    break
+                with self._lock:
+                    session = self._joinable(key)
+                if session:
+                    return TranscodeClient(session)
+        finally:
+            with self._lock:
+                self.queued -= 1
+
+        # started holding the lock, so waiters that got a slot at the same
+        # time join it instead of starting another ffmpeg
+        with self._lock:
+            session = self._joinable(key)
+            if session:
+                self._slots.release()
+                return TranscodeClient(session)
+            try:
+                session = TranscodeSession(
+                    key, cmd, self,
+                    max_buffer_chunks=self.max_buffer_chunks,
+                    share_window=self.share_window
+                )
+                session.start()
+            except Exception:
+                self._slots.release()
+                raise
+            self.sessions[key] = session
+        log.info(f"Started transcode {key}, pid {session.process.pid}")
+        return TranscodeClient(session)
+
+    def reap(self, session):
+        """
+        Stop ffmpeg and free its slot, the buffered output stays available
+        to clients still reading it.
+        """
+        with self._lock:
+            if session.reaped:
+                return
+            session.reaped = True
+            if self.sessions.get(session.key) is session:
+                del self.sessions[session.key]
+
+        session.cpu_time = process_cpu_time(session.process.pid) or 0.0
+        session.process.kill()
+        session.process.wait()
+        session.process.stdout.close()
+        self._slots.release()
+
+        with self._lock:
+            self.total_cpu_time += session.cpu_time
+            self.total_bytes_out += session.bytes_out
+            self.total_transcodes += 1
+        FFMPEG_SECONDS.observe(time() - session.started)
+        log.info(
+            f"Transcode {session.key} finished, pid {session.process.pid}, "
+            f"{session.bytes_out / 1024 / 1024:.2f} MB out, "
+            f"{session.cpu_time:.1f}s CPU"
+        )
+
+    def close(self, session):
+        # last client gone
+        self.reap(session)
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self.sessions.values())
+            queued = self.queued
+            total_cpu_time = self.total_cpu_time
+            total_bytes_out = self.total_bytes_out
+            total_transcodes = self.total_transcodes
+        return {
+            "active": len(sessions),
+            "queued": queued,
+            "max_processes": self.max_processes,
+            "total_cpu_time": total_cpu_time,
+            "total_bytes_out": total_bytes_out,
+            "total_transcodes": total_transcodes,
+            "sessions": [session.stats() for session in sessions],
+        }
+
+
+class AsyncTranscodeSession(TranscodeSession):
+    """
+    TranscodeSession for the ASGI server, reading ffmpeg's stdout through
+    an asyncio pipe. It only runs on the event loop, so the condition's lock
+    is never contended and waiting is done with asyncio events instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._new_chunk = asyncio.Event()
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            *self.cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+
+    def _notify(self):
+        event, self._new_chunk = self._new_chunk, asyncio.Event()
+        event.set()
+
+    async def read(self, client_id, timeout=30):
+        """
+        Next chunk for client_id, or None at the end of the output, if the
+        client fell behind the buffer, or if no chunk came for timeout
+        seconds.
+        """
+        while True:
+            with self._cond:
+                seq = self.cursors.get(client_id)
+                if seq is None or seq < self.base_seq:
+                    return None
+                if seq < self.base_seq + len(self.chunks):
+                    self.cursors[client_id] = seq + 1
+                    return self.chunks[seq - self.base_seq]
+                if self.eof or self.reaped:
+                    return None
+            if self._reading:
+                try:
+                    await asyncio.wait_for(self._new_chunk.wait(), timeout)
+                except asyncio.TimeoutError:
+                    return None
+                continue
+
+            self._reading = True
+            try:
+                chunk = await self.process.stdout.read(self.chunk_size)
+            except Exception:
+                chunk = b""
+            finally:
+                # also when the reading client is cancelled (it went away),
+                # so another one takes over reading instead of waiting
+                self._reading = False
+                self._notify()
+
+            with self._cond:
+                if chunk:
+                    self.chunks.append(chunk)
+                    self.bytes_out += len(chunk)
+                    self._trim()
+                else:
+                    self.eof = True
+            if not chunk:
+                self.manager.reap(self)
+
+
+class AsyncTranscodeClient(TranscodeClient):
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = None if self.closed else await self.session.read(self.client_id)  # noqa
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+
+class AsyncTranscodeManager(TranscodeManager):
+    """
+    TranscodeManager for the ASGI server, open() returns an async iterable
+    client that must be close()d once done.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = asyncio.Semaphore(self.max_processes)
+
+    async def open(self, key, cmd):
+        deadline = monotonic() + self.queue_timeout
+        session = self._joinable(key)
+        if session:
+            return AsyncTranscodeClient(session)
+
+        self.queued += 1
+        try:
+            while True:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    log.info(f"No transcode slot for {key} after {self.queue_timeout}s")  # noqa
+                    raise TranscodeBusy(key)
+                try:
+                    await asyncio.wait_for(
+                        self._slots.acquire(),
+                        timeout=min(remaining, JOIN_POLL)
+                    )
+                    break
+                except asyncio.TimeoutError:
+                    pass
+                session = self._joinable(key)
+                if session:
+                    return AsyncTranscodeClient(session)
+        finally:
+            self.queued -= 1
+
+        session = self._joinable(key)
+        if session:
+            self._slots.release()
+            return AsyncTranscodeClient(session)
+
+        session = AsyncTranscodeSession(
+            key, cmd, self,
+            max_buffer_chunks=self.max_buffer_chunks,
+            share_window=self.share_window
+        )
+        try:
+            await session.start()
+        except Exception:
+            self._slots.release()
+            raise
+
+        self.sessions[key] = session
+        log.info(f"Started transcode {key}, pid {session.process.pid}")
+        return AsyncTranscodeClient(session)
+
+    def reap(self, session):
+        if session.reaped:
+            return
+        session.reaped = True
+        if self.sessions.get(session.key) is session:
+            del self.sessions[session.key]
+
+        session.cpu_time = process_cpu_time(session.process.pid) or 0.0
+        try:
+            session.process.kill()
+        except ProcessLookupError:
+            pass
+        asyncio.ensure_future(session.process.wait())
+        self._slots.release()
+        session._notify()
+
+        self.total_cpu_time += session.cpu_time
+        self.total_bytes_out += session.bytes_out
+        self.total_transcodes += 1
+        FFMPEG_SECONDS.observe(time() - session.started)
+        log.info(
+            f"Transcode {session.key} finished, pid {session.process.pid}, "
+            f"{session.bytes_out / 1024 / 1024:.2f} MB out, "
+            f"{session.cpu_time:.1f}s CPU"
+        )
@@ -1,8 +1,14 @@
 import sys
 import json
+import os
 import requests
 from time import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import datafile  # noqa: E402
+from catalog_store import sqlite_catalog  # noqa: E402
+
 
 # our main data file
 if len(sys.argv) < 2:
@@ -14,8 +20,12 @@ with open(config_file) as f:
     CONFIG = json.load(f)
 
 json_data_file = CONFIG.get('json_data_file', 'final_data.json')
-with open(json_data_file, "r") as f:
-    data = json.load(f)
+# with the SQLite catalog, new channels go straight into it
+store = sqlite_catalog(CONFIG)
+if store:
+    data = {"live_streams": store.records("live_streams")}
+else:
+    data = datafile.load(json_data_file)
 
 live_nums = [
     live_stream.get('num') for live_stream in data.get('live_streams')
@@ -88,9 +98,14 @@ for ambit in tdtch_data['countries'][0]['ambits']:
             f"Channels Found: {channels_found}"
         )
 
-data['live_categories'].extend(live_categories)
-data['live_streams'].extend(live_streams)
-
-with open(json_data_file, "w") as f:
-    json.dump(data, f, indent=4)
-print(f"Added {len(live_streams)} live streams to {json_data_file}.")
+if store:
+    store.add_records(append={
+        "live_categories": live_categories, "live_streams": live_streams
+    })
+    print(f"Added {len(live_streams)} live streams to {store.db_file}.")
+else:
+    data['live_categories'].extend(live_categories)
+    data['live_streams'].extend(live_streams)
+
+    datafile.dump(data, json_data_file)
+    print(f"Added {len(live_streams)} live streams to {json_data_file}.")
@@ -3,6 +3,11 @@ import json
 import os
 from time import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import datafile  # noqa: E402
+from catalog_store import sqlite_catalog  # noqa: E402
+
 
 if len(sys.argv) < 2:
     print("Usage: python add_vod_files.py config.json")
@@ -13,8 +18,17 @@ with open(config_file) as f:
     CONFIG = json.load(f)
 
 json_data_file = CONFIG.get('json_data_file', 'final_data.json')
-with open(json_data_file, "r") as f:
-    data = json.load(f)
+# with the SQLite catalog, new movies go straight into it
+store = sqlite_catalog(CONFIG)
+if store:
+    data = {
+        key: store.records(key)
+        for key in ("movie_streams", "movie_categories")
+    }
+else:
+    data = datafile.load(json_data_file)
+new_categories = []
+new_movies = []
 
 vod_nums = [
     movie_stream.get('num') for movie_stream in data.get('movie_streams')
@@ -89,6 +103,7 @@ with open(csv_file, "r") as f:
             }
             # Add in first position, so clients show it first
             data['movie_categories'].insert(0, new_category)
+            new_categories.insert(0, new_category)
 
         vod = {
             "num": next_vod_num,
@@ -104,10 +119,16 @@ with open(csv_file, "r") as f:
         next_vod_num += 1
         next_stream_id += 1
         data['movie_streams'].append(vod)
-
-if movies_added > 0:
-    with open(json_data_file, "w") as f:
-        json.dump(data, f, indent=4)
+        new_movies.append(vod)
+
+if movies_added > 0 and store:
+    store.add_records(
+        append={"movie_streams": new_movies},
+        prepend={"movie_categories": new_categories}
+    )
+    print(f"Added {movies_added} movies to {store.db_file}.")
+elif movies_added > 0:
+    datafile.dump(data, json_data_file)
     print(f"Added {movies_added} movies to {json_data_file}.")
 else:
     print("No new movies were added.")
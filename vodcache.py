@@ -0,0 +1,339 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time, perf_counter
+
+import requests
+
+from metrics import UPSTREAM_TTFB_SECONDS, UPSTREAM_ERRORS
+
+
+log = logging.getLogger(__name__)
+
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def cache_key(source):
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+
+def parse_range(range_header, size):
+    """
+    (start, end) of a single byte range header, end inclusive, or None if
+    it isn't one or it's past the end of size bytes.
+    """
+    match = RANGE.match((range_header or "").strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+class CachedRange:
+    """
+    File-like part of a cached movie, from start and up to length bytes.
+    read() never goes past length, while fileno() and the file position
+    let WSGI servers with a sendfile file_wrapper (gunicorn, uWSGI) send it
+    with sendfile, given the Content-Length. on_close() is called once it's
+    closed.
+    """
+
+    def __init__(self, path, start, length, size, content_type, partial):
+        self.file = open(path, "rb")
+        self.file.seek(start)
+        self.start = start
+        self.length = length
+        self.size = size
+        self.content_type = content_type
+        self.partial = partial
+        self.remaining = length
+        self.on_close = None
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        chunk = self.file.read(size) if size else b""
+        self.remaining -= len(chunk)
+        return chunk
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+        on_close, self.on_close = self.on_close, None
+        if on_close:
+            on_close()
+
+    def headers(self):
+        headers = {
+            "Accept-Ranges": "bytes",
+            "Content-Length": str(self.length),
+        }
+        if self.partial:
+            headers["Content-Range"] = \
+                f"bytes {self.start}-{self.start + self.length - 1}/{self.size}"  # noqa
+        return headers
+
+
+class VodCache:
+    """
+    Read-through disk cache of movies. A movie requested min_requests
+    times is fetched from origin in the background, in order, into
+    cache_dir. Ranges already on disk are served from there, even while the
+    rest is still being fetched; other requests go to origin as before.
+    Movies are evicted least recently used first to keep the cache under
+    max_gb. Interrupted fills resume from where they stopped. Requests are
+    counted for at most max_counted movies not cached yet, least recently
+    requested ones are forgotten first.
+    """
+
+    def __init__(self, cache_dir="vod_cache", max_gb=20, min_requests=2,
+                 fill_workers=2, chunk_size=1024*1024, timeout=30,
+                 max_counted=10000):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_gb * 1024 * 1024 * 1024)
+        self.min_requests = min_requests
+        self.max_counted = max_counted
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.index_file = os.path.join(cache_dir, "index.json")
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # key: {"size", "filled", "content_type", "last_access"}, size is
+        # None until the fill starts
+        self.entries = {}
+        # key: requests, of movies not cached yet, least recent first
+        self.requests = OrderedDict()
+        self.filling = set()
+        self._lock = threading.Lock()
+        self._fillers = ThreadPoolExecutor(
+            max_workers=fill_workers, thread_name_prefix="vod-fill"
+        )
+
+        self.hits = 0
+        self.misses = 0
+        self.served_bytes = 0
+        self.filled_bytes = 0
+        self.seeks = 0
+        self.seek_seconds = 0.0
+        self.origin_requests = 0
+        self.origin_ttfb_seconds = 0.0
+
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    saved = json.load(f)
+            except Exception as e:
+                log.info(f"Ignoring unreadable VOD cache index {self.index_file}: {e}")  # noqa
+                saved = {}
+            for key, entry in saved.items():
+                path = self._path(key)
+                if os.path.exists(path):
+                    # whatever got written before a restart is still good
+                    entry["filled"] = min(
+                        os.path.getsize(path), entry["size"] or 0
+                    )
+                    self.entries[key] = entry
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.data")
+
+    def save(self):
+        with self._lock:
+            saved = json.dumps(self.entries)
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(saved)
+        os.replace(tmp_file, self.index_file)
+
+    def open(self, key, url, range_header=None):
+        """
+        The part of key asked for by range_header as a CachedRange, or
+        None if it isn't on disk (yet) and the request should go to url.
+        """
+        started = perf_counter()
+        with self._lock:
+            entry = self.entries.get(key)
+            if key in self.filling:
+                fill = False
+            elif entry is None:
+                count = self.requests.pop(key, 0) + 1
+                fill = count >= self.min_requests
+                if not fill:
+                    self.requests[key] = count
+                    while len(self.requests) > self.max_counted:
+                        self.requests.popitem(last=False)
+            else:
+                # resume an interrupted fill
+                fill = entry["filled"] < (entry["size"] or 1)
+            if fill:
+                self.filling.add(key)
+            cached = None
+            if entry and entry["size"]:
+                entry["last_access"] = int(time())
+                cached = dict(entry)
+        if fill:
+            self._fillers.submit(self._fill, key, url)
+
+        cached_range = None
+        try:
+            cached_range = self._cached_range(key, cached, range_header)
+        except OSError:
+            # evicted meanwhile
+            pass
+
+        with self._lock:
+            if cached_range is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.served_bytes += cached_range.length
+            if cached_range.start:
+                self.seeks += 1
+                self.seek_seconds += perf_counter() - started
+        return cached_range
+
+    def _cached_range(self, key, cached, range_header):
+        if not cached:
+            return None
+        if not range_header:
+            if cached["filled"] < cached["size"]:
+                return None
+            return CachedRange(
+                self._path(key), 0, cached["size"], cached["size"],
+                cached["content_type"], False
+            )
+        byte_range = parse_range(range_header, cached["size"])
+        if not byte_range or byte_range[0] >= cached["filled"]:
+            return None
+        # a partial response up to what's on disk, players ask for the
+        # rest afterwards
+        start, end = byte_range
+        end = min(end, cached["filled"] - 1)
+        return CachedRange(
+            self._path(key), start, end - start + 1, cached["size"],
+            cached["content_type"], True
+        )
+
+    def _evict(self, needed):
+        """
+        Drop least recently used movies until needed more bytes fit.
+        """
+        with self._lock:
+            used = sum(entry["size"] or 0 for entry in self.entries.values())
+            candidates = sorted(
+                (entry["last_access"], key)
+                for key, entry in self.entries.items()
+                if key not in self.filling
+            )
+            evicted = []
+            while used + needed > self.max_bytes and candidates:
+                _, key = candidates.pop(0)
+                used -= self.entries.pop(key)["size"] or 0
+                evicted.append(key)
+        for key in evicted:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            log.info(f"Evicted {key} from VOD cache")
+        return used + needed <= self.max_bytes
+
+    def _fill(self, key, url):
+        try:
+            self._fill_from(key, url)
+        except Exception as e:
+            UPSTREAM_ERRORS.inc("vod_fill")
+            log.info(f"Error filling VOD cache with {key}: {e}")
+        finally:
+            with self._lock:
+                self.filling.discard(key)
+            self.save()
+
+    def _fill_from(self, key, url):
+        with self._lock:
+            entry = self.entries.get(key)
+            filled = entry["filled"] if entry else 0
+        headers = {"Range": f"bytes={filled}-"} if filled else {}
+
+        started = perf_counter()
+        with requests.get(
+            url, headers=headers, stream=True, timeout=self.timeout
+        ) as response:
+            ttfb = perf_counter() - started
+            UPSTREAM_TTFB_SECONDS.observe(ttfb, "vod_fill")
+            with self._lock:
+                self.origin_requests += 1
+                self.origin_ttfb_seconds += ttfb
+            if response.status_code not in (200, 206):
+                raise IOError(f"HTTP {response.status_code}")
+            if filled and response.status_code == 200:
+                # origin ignored the range, start over
+                filled = 0
+
+            if entry is None or not filled:
+                with self._lock:
+                    self.entries.pop(key, None)
+                size = int(response.headers.get("Content-Length") or 0)
+                if not size:
+                    raise IOError("origin didn't send a Content-Length")
+                if size > self.max_bytes / 2 or not self._evict(size):
+                    log.info(f"Not caching {key}, {size} bytes don't fit")
+                    return
+                entry = {
+                    "size": size,
+                    "filled": 0,
+                    "content_type":
+                        response.headers.get("Content-Type", "video/mp4"),
+                    "last_access": int(time()),
+                }
+                with self._lock:
+                    self.entries[key] = entry
+
+            log.info(f"Filling VOD cache with {key} from byte {filled}")
+            with open(self._path(key), "r+b" if filled else "wb") as f:
+                f.seek(filled)
+                f.truncate()
+                for chunk in response.iter_content(self.chunk_size):
+                    f.write(chunk)
+                    # readers open their own file, make it visible first
+                    f.flush()
+                    with self._lock:
+                        entry["filled"] += len(chunk)
+                        self.filled_bytes += len(chunk)
+                    if key not in self.entries:
+                        return
+        log.info(f"VOD cache filled with {key} ({entry['filled']} bytes)")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "movies": len(self.entries),
+                "bytes": sum(e["filled"] for e in self.entries.values()),
+                "filling": len(self.filling),
+                "hits": self.hits,
+                "misses": self.misses,
+                "served_bytes": self.served_bytes,
+                "filled_bytes": self.filled_bytes,
+                # origin egress the cache avoided, net of filling it
+                "egress_saved_bytes": self.served_bytes - self.filled_bytes,
+                "seeks": self.seeks,
+                "seek_latency_ms":
+                    self.seek_seconds / self.seeks * 1000 if self.seeks else 0,
+                "origin_ttfb_ms":
+                    self.origin_ttfb_seconds / self.origin_requests * 1000
+                    if self.origin_requests else 0,
+            }